@@ -16,6 +16,7 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import json
+import pickle
 import sys
 import datetime
 import argparse
@@ -23,6 +24,8 @@ import tempfile
 import os
 import csv
 import subprocess
+import signal
+import heapq
 
 try:
     from colorama import just_fix_windows_console
@@ -30,79 +33,77 @@ try:
 except:
     print('Failed to import Colorama. Colored output may be wrong. You should run "pip install colorama" and make sure you have at least v0.4.6', file=sys.stderr)
 
-class Movie:
-    def __init__(self, obj, source):
-        self.obj = obj
-        self.source = source
-        self.record = None
-
-    def get_title(self, lower=False):
-        return self.obj['title'].lower() if lower else self.obj['title']
+# Dates are kept as ordinals so sorting doesn't need to parse anything. 0 means there's no date.
+def date_ordinal(datestr):
+    # Anything that isn't a date is rejected quickly, strptime failing is slow and most descriptions aren't dates.
+    if not isinstance(datestr, str) or not datestr[:1].isdigit():
+        return 0
 
-    def get_runtime(self, default=None):
-        return int(self.obj['runtime']) if len(self.obj['runtime']) > 0 else default
-
-    def get_released(self):
-        return datetime.datetime.strptime(self.obj['released'], '%Y-%m-%d')
-
-    def get_watched(self):
-        return datetime.datetime.strptime(self.obj['watched'], '%Y-%m-%d')
-
-    def get_rating(self, default=None):
-        return float(self.obj['rating']) if self.obj['rating'] != '' else default
+    try:
+        return datetime.date.fromisoformat(datestr).toordinal()
+    except (TypeError, ValueError):
+        pass
 
-    def get_votes(self):
-        return int(self.obj['votes'])
+    try:
+        return datetime.datetime.strptime(datestr, '%Y-%m-%d').toordinal()
+    except (TypeError, ValueError):
+        return 0
 
-    def get_metascore(self, default=None):
-        return int(self.obj['metascore']) if self.obj['metascore'] != '-1' else default
+# Everything is decoded once when the movie is loaded. The sorts, the columns and the exclusions all read the fields directly.
+# Missing values are None, except dates which are 0.
+class Movie:
+    __slots__ = ('source', 'record', 'iden', 'title', 'title_lower', 'runtime', 'released', 'watched', 'rating', 'votes',
+        'metascore', 'myrating', 'description', 'days_left', 'crew', 'crew_lower')
 
-    def get_myrating(self, default=None):
-        return int(self.obj['myrating']) if len(self.obj['myrating']) > 0 else default
+    def __init__(self, obj, source, crew_types=()):
+        self.source = source
+        self.record = None
 
-    def get_days_left(self, default=None):
-        try:
-            date = datetime.datetime.strptime(self.get_description(), '%Y-%m-%d')
-        except:
-            return default
+        # The header is a dummy movie with nothing in it.
+        if obj == None:
+            return
 
-        return (date - datetime.datetime.today()).days
+        self.iden = obj['imdbID']
+        self.title = obj['title']
+        self.title_lower = self.title.lower()
+        self.runtime = int(obj['runtime']) if len(obj['runtime']) > 0 else None
+        self.released = date_ordinal(obj['released'])
+        self.watched = date_ordinal(obj['watched'])
+        self.rating = float(obj['rating']) if obj['rating'] != '' else None
+        self.votes = int(obj['votes'])
+        self.metascore = int(obj['metascore']) if obj['metascore'] != '-1' else None
+        self.myrating = int(obj['myrating']) if len(obj['myrating']) > 0 else None
+        self.description = obj['description']
 
-    def get_description(self):
-        return self.obj['description']
+        # The description of a movie that's leaving is the date it's leaving on.
+        leaving = date_ordinal(self.description)
+        self.days_left = (datetime.datetime.fromordinal(leaving) - now).days if leaving != 0 else None
 
-    def get_crew(self, crew_type, lower=False, default=None):
-        if len(self.obj[crew_type]) == 0:
-            return default
+        self.crew = dict()
+        self.crew_lower = dict()
 
-        # Some crew types should be sorted, some not. It's the same as which should be grouped and which not.
-        sort_crew = {
-            ct_cast: False,
-            ct_producer: False,
-            ct_stunt_performer: False,
-            ct_editor: True,
-            ct_writer: True,
-            ct_director: True,
-            ct_composer: True,
-            ct_cinematographer: True,
-        }
+        for crew_type in crew_types:
+            # JSONs fetched with --crew may not have every crew type.
+            crew = [member['name'] for member in obj.get(crew_type, [])]
 
-        crew = (member['name'].lower() if lower else member['name'] for member in self.obj[crew_type])
+            if len(crew) == 0:
+                continue
 
-        # The list returned may not be lower, but it's always sorted as if it was.
-        return sorted(crew, key=str.lower) if sort_crew[crew_type] else list(crew)
+            # The list may not be lower, but it's always sorted as if it was.
+            if sort_crew[crew_type]:
+                crew.sort(key=str.lower)
 
-    def get_iden(self):
-        return self.obj['imdbID']
+            self.crew[crew_type] = crew
+            self.crew_lower[crew_type] = tuple(name.lower() for name in crew)
 
     def __eq__(self, o):
-        return isinstance(o, Movie) and self.get_iden() == o.get_iden()
+        return isinstance(o, Movie) and self.iden == o.iden
 
     def __ne__(self, o):
         return not self == o
 
     def __hash__(self):
-        return hash(self.get_iden())
+        return hash(self.iden)
 
 def alias(valid_items, aliases, item):
     aliases.update({key: key for key in valid_items})
@@ -272,6 +273,14 @@ def exclude_aliases(exclude_keys):
 
     return keys
 
+def positive_int(num):
+    num = int(num)
+
+    if num <= 0:
+        raise ValueError()
+
+    return num
+
 def join_keys(keys):
     return ', '.join((f"'{k}'" for k in keys))
 
@@ -303,65 +312,147 @@ def runtime_str(runtime):
     mins = runtime % 60
     return f'{str(hrs)}:{str(mins).zfill(2)}'
 
+# Returns whether the key is descending by default, whether its values are numbers, and the key itself.
 def sort_func(sort_key):
     if sort_key == sk_released:
-        return True, lambda movie: movie.get_released()
+        return True, True, lambda movie: movie.released
     if sort_key == sk_watched:
-        return True, lambda movie: movie.get_watched()
+        return True, True, lambda movie: movie.watched
     if sort_key == sk_rating:
-        return True, lambda movie: movie.get_rating(-1)
+        return True, True, lambda movie: movie.rating if movie.rating != None else -1
     if sort_key == sk_votes:
-        return True, lambda movie: movie.get_votes()
+        return True, True, lambda movie: movie.votes
     if sort_key == sk_metascore:
-        return True, lambda movie: movie.get_metascore(-1)
+        return True, True, lambda movie: movie.metascore if movie.metascore != None else -1
     if sort_key == sk_myrating:
-        return True, lambda movie: movie.get_myrating(-1)
+        return True, True, lambda movie: movie.myrating if movie.myrating != None else -1
     if sort_key == sk_runtime:
-        return False, lambda movie: movie.get_runtime(-1)
+        return False, True, lambda movie: movie.runtime if movie.runtime != None else -1
     if sort_key == sk_leaving:
-        return False, lambda movie: movie.get_days_left(0x7FFFFFFF)
+        return False, True, lambda movie: movie.days_left if movie.days_left != None else 0x7FFFFFFF
     if sort_key == sk_alpha:
-        return False, lambda movie: movie.get_title(True)
+        return False, False, lambda movie: movie.title_lower
     if sort_key == sk_description:
-        return False, lambda movie: movie.get_description().lower()
+        return False, False, lambda movie: movie.description.lower()
     if sort_key in valid_crew_types:
-        return False, lambda movie: tuple(movie.get_crew(sort_key, True, []))
+        return False, False, lambda movie: movie.crew_lower.get(sort_key, ())
+
+    return False, True, lambda movie: 0
+
+# Wraps a value so it compares in the opposite order. Only needed for things that can't just be negated.
+class Reversed:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, o):
+        return o.value < self.value
+
+    def __eq__(self, o):
+        return self.value == o.value
 
-    return False, lambda movie: 0
+# One key for all the sort keys together, so sorting by all of them takes only one pass.
+def composite_key(sort_keys):
+    funcs = []
+
+    for sk in sort_keys:
+        reverse, numeric, sorter = sort_func(sk)
+
+        if not reverse ^ reverse_all:
+            funcs.append(sorter)
+        elif numeric:
+            funcs.append(lambda movie, sorter=sorter: -sorter(movie))
+        else:
+            funcs.append(lambda movie, sorter=sorter: Reversed(sorter(movie)))
+
+    if len(funcs) == 1:
+        return funcs[0]
+
+    return lambda movie: tuple([func(movie) for func in funcs])
+
+def date_str(ordinal, fmt):
+    return datetime.date.fromordinal(ordinal).strftime(fmt)
 
 def get_column(movie, col_key):
     if col_key == ck_title:
-        return clampstr(movie.get_title(), maxlen=45)
+        return clampstr(movie.title, maxlen=45)
     if col_key == ck_leaving:
-        return do(str, movie.get_days_left(), '-')
+        return do(str, movie.days_left, '-')
     if col_key == ck_runtime:
-        return do(runtime_str, movie.get_runtime(), '-')
+        return do(runtime_str, movie.runtime, '-')
     if col_key == ck_released:
-        return movie.get_released().strftime(rdate_fmt)
+        return date_str(movie.released, rdate_fmt) if movie.released != 0 else '-'
     if col_key == ck_rating:
-        return do(str, movie.get_rating(), '-')
+        return do(str, movie.rating, '-')
     if col_key == ck_votes:
-        return num_to_pretty_str(movie.get_votes(), abbreviate=not verbose)
+        return num_to_pretty_str(movie.votes, abbreviate=not verbose)
     if col_key == ck_metascore:
-        return do(str, movie.get_metascore(), '-')
+        return do(str, movie.metascore, '-')
     if col_key == ck_watched:
-        return movie.get_watched().strftime(wdate_fmt)
+        return date_str(movie.watched, wdate_fmt) if movie.watched != 0 else '-'
     if col_key == ck_myrating:
-        return do(str, movie.get_myrating(), '-')
+        return do(str, movie.myrating, '-')
     if col_key == ck_source:
         return clampstr(movie.source, from_start=False) # From the end because in long paths the end matters most.
     if col_key == ck_description:
-        return clampstr(movie.get_description())
+        return clampstr(movie.description)
     if col_key in valid_crew_types:
-        return do(lambda l: clampstr(', '.join(l)), movie.get_crew(col_key), '-')
+        return do(lambda l: clampstr(', '.join(l)), movie.crew.get(col_key), '-')
+
+# mfetch --store writes a compact copy of the JSON next to it, which is a lot faster to load. Mostly because we only unpack the crew types we use.
+# It's only used if it's newer than the JSON, otherwise the JSON was changed after it and it's out of date.
+def load_store(path, crew_types):
+    with open(path, 'rb') as f:
+        store = pickle.load(f)
+
+    if store['version'] != 1:
+        raise ValueError(f'Unknown store version: {store["version"]}')
+
+    shapes = store['shapes']
+    people = store['people']
+    movies = [dict(zip(shapes[row[0]], row[1:])) for row in store['rows']]
 
+    for crew_type in crew_types:
+        if crew_type not in store['crew']:
+            continue
+
+        for movie, credits in zip(movies, pickle.loads(store['crew'][crew_type])):
+            if credits != None:
+                movie[crew_type] = [{'id': people[i][0], 'name': people[i][1], 'roles': list(roles)} for i, roles in credits]
+
+    return {'movies': movies}
+
+def load_movies(matching_file, crew_types):
+    if matching_file != '-':
+        store_file = matching_file.removesuffix('.json') + '.mstore'
+
+        try:
+            if os.path.getmtime(store_file) >= os.path.getmtime(matching_file):
+                return load_store(store_file, crew_types)
+        except Exception:
+            # No store or a broken one, either way there's always the JSON.
+            pass
+
+    with sys.stdin if matching_file == '-' else open(matching_file, 'r') as f:
+        return json.load(f)
+
+# Exclusions check the decoded fields directly instead of building the column.
 def is_default(movie, xkey):
-    return get_column(movie, column_alias(xkey)) == '-'
+    if xkey == ck_metascore:
+        return movie.metascore == None
+    if xkey == ck_myrating:
+        return movie.myrating == None
+    if xkey == ck_leaving:
+        return movie.days_left == None
+
+    return False
 
 # Assumes that input is valid. That means:
 # records is a matrix of strings (that is, a list of equal-length lists of strings).
 # use_colors is False or colors is a nonempty list of color codes.
-def tabulate(records, fillchar=' ', spacious=False, use_color=True, underline_header=True, file=sys.stdout,
+# Yields the table line by line so it can be streamed to wherever it's going.
+def tabulate(records, fillchar=' ', spacious=False, use_color=True, underline_header=True,
     fillcolor=  '\033[30;1m\033[K', # Gray
     column_colors=[
                 '\033[39m\033[K',   # White
@@ -388,20 +479,22 @@ def tabulate(records, fillchar=' ', spacious=False, use_color=True, underline_he
         fillcolor = ''
         headercolor = ''
 
+    # Everything that doesn't depend on the entry itself is computed once per column.
+    # Each entry gets its padding by slicing a full-width fill string, which is a lot cheaper than multiplying it out each time.
+    colors = [column_colors[col % len(column_colors)] for col in range(ncolumns)]
+    fills = [maxlen * fillchar for maxlen in maxlens]
+    after = f'{nocolor}{fillcolor}'
+
+    def render(record, headercolor):
+        return ''.join(f'{colors[col]}{headercolor}{entry}{after}{fills[col][len(entry):]}{nocolor}' for col, entry in enumerate(record))
+
     # Printing columns, with alignment and color!
     # Note: This program, and my other python scripts, all hit 'OSError [Errno 22]' when piping to less.
     # This fixes it: https://stackoverflow.com/a/66874837/12553917, but I'm worried about the consequences of using this and it's not worth the hassle.
-    for row, record in enumerate(records):
-        for col, entry in enumerate(record):
-            color = column_colors[col % len(column_colors)]
-            print(f'{color}{headercolor}{entry}{nocolor}{fillcolor}{(maxlens[col] - len(entry)) * fillchar}{nocolor}', end='', file=file)
-        
-        print(file=file)
-
-        if spacious and row < len(records) - 1:
-            print(file=file)
+    yield render(records[0], headercolor) + '\n' # Only the header gets the header color.
 
-        headercolor = '' # After first row, make header color none.
+    for record in records[1:]:
+        yield ('\n' if spacious else '') + render(record, '') + '\n'
 
 # This is needed. Trust me.
 try:
@@ -419,6 +512,18 @@ ct_cinematographer = 'cinematographer'
 ct_stunt_performer = 'stunt performer'
 valid_crew_types = [ct_cast, ct_editor, ct_writer, ct_director, ct_composer, ct_producer, ct_cinematographer, ct_stunt_performer]
 
+# Some crew types should be sorted, some not. It's the same as which should be grouped and which not.
+sort_crew = {
+    ct_cast: False,
+    ct_producer: False,
+    ct_stunt_performer: False,
+    ct_editor: True,
+    ct_writer: True,
+    ct_director: True,
+    ct_composer: True,
+    ct_cinematographer: True,
+}
+
 sk_released = 'released'
 sk_watched = 'watched'
 sk_nosort = 'none'
@@ -487,6 +592,8 @@ parser.add_argument('-L', '--less', choices=['always', 'auto', 'never'], default
     'Choose whether to paginate with less. Defaults to %(default)s')
 parser.add_argument('-f', '--date-format', metavar='FORMAT', default=None, action='store', help=
     'Override format for date columns. Default depends on verbosity and which column. See python datetime.strftime documentation for format syntax')
+parser.add_argument('-n', '--limit', metavar='NUM', type=positive_int, default=None, action='store', help=
+    'Only print the first %(metavar)s movies. Much faster than sorting everything when you just want to see the top of a big list')
 parser.add_argument('-t', '--no-titles', default=False, action='store_true', help=
     'Don\'t print a row with the column titles')
 parser.add_argument('JSON', nargs='*', action='store', help=
@@ -513,6 +620,7 @@ exclude_keys = args.exclude
 titles = not args.no_titles
 jsonfiles = ['-'] if len(args.JSON) == 0 else args.JSON
 date_fmt = args.date_format
+limit = args.limit
 
 # Quick check that the format is valid.
 if date_fmt != None:
@@ -560,8 +668,11 @@ if args.columns[0]:
 else:
     column_keys = args.columns[1]
 
+# Crew types which aren't shown or sorted by don't need to be loaded.
+used_crew_types = [ct for ct in valid_crew_types if ct in column_keys or ct in sort_keys]
 movies = list()
 read_stdin = False
+now = datetime.datetime.today() # For days left. Better that every movie counts from the same moment.
 
 for jsonfile in jsonfiles:
     # Ugly way to skip stdin after the first time because it will be closed for subsequent times.
@@ -581,25 +692,28 @@ for jsonfile in jsonfiles:
     except:
         sys.exit(f"{jsonfile}: No such file.")
         
-    with sys.stdin if matching_file == '-' else open(matching_file, 'r') as f:
-        data = json.load(f)
-
-    file_movies = [Movie(movie_json, jsonfile) for movie_json in data['movies']]
+    data = load_movies(matching_file, used_crew_types)
+    file_movies = [Movie(movie_json, jsonfile, used_crew_types) for movie_json in data['movies']]
     movies.extend(m for m in file_movies if all(not is_default(m, xkey) for xkey in exclude_keys))
 
 if uniqify:
     movies = list(set(movies))
 
-# Set each movie's table record.
+if limit != None:
+    # Only the top movies are wanted, no need to sort them all. This gives the same movies in the same order as sorting and cutting would.
+    movies = heapq.nsmallest(limit, movies, key=composite_key(sort_keys))
+else:
+    # Sort the movies according to the sort key. Must iterate in reverse priority order.
+    # Note there is an assumption here that the sort is stable.
+    # This is faster than sorting once by composite_key, because python's sort is at its fastest with simple keys and no ties to break.
+    for sk in sort_keys[::-1]:
+        reverse, _, sorter = sort_func(sk)
+        movies.sort(key=sorter, reverse=reverse ^ reverse_all)
+
+# Set each movie's table record. Done after sorting so only movies which are actually shown get formatted.
 for movie in movies:
     movie.record = [get_column(movie, ck) for ck in column_keys]
 
-# Sort the movies according to the sort key. Must iterate in reverse priority order.
-# Note there is an assumption here that the sort is stable.
-for sk in sort_keys[::-1]:
-    reverse, sorter = sort_func(sk)
-    movies.sort(key=sorter, reverse=reverse ^ reverse_all)
-
 # Inserting a dummy object with the column names.
 column_titles = {
     ck_title: 'Title',
@@ -637,22 +751,54 @@ if less == None:
     else:
         less = False
 
-# Pipe to less if requested. I tried a lot of variations including of course Popen(stdin=PIPE), this is the only one that works.
-with tempfile.NamedTemporaryFile('w', encoding='utf-8') if less else sys.stdout as f:
+def write_table(f):
     # Output movies in a pretty table.
     if dsv:
         writer = csv.writer(f, delimiter=delim)
         writer.writerows(movie.record for movie in movies)
     else:
-        tabulate([movie.record for movie in movies], fillchar='.' if color else ' ', 
-            spacious=spacious, use_color=color, underline_header=titles, file=f)
-    
+        # Lines are written as they're rendered, the stream's buffer is what batches them into big writes.
+        f.writelines(tabulate([movie.record for movie in movies], fillchar='.' if color else ' ',
+            spacious=spacious, use_color=color, underline_header=titles))
+
     f.flush()
 
-    if less:
+def less_failed():
+    print("-L option failed. You either don't have less it or it is not in PATH.", file=sys.stderr)
+
+if not less:
+    with sys.stdout as f:
+        write_table(f)
+elif os.name == 'nt':
+    # Pipe to less if requested. On Windows I tried a lot of variations including of course Popen(stdin=PIPE), this is the only one that works.
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8') as f:
+        write_table(f)
+
         try:
             ps = subprocess.Popen(['less', '-RS', f.name])
             ps.wait()
         except:
-            print("-L option failed. You either don't have less it or it is not in PATH.", file=sys.stderr)
+            less_failed()
+else:
+    # Everywhere else we can stream the table into less, so the first screen shows up without waiting for the whole table to be written.
+    try:
+        ps = subprocess.Popen(['less', '-RS'], stdin=subprocess.PIPE, encoding='utf-8')
+    except OSError:
+        less_failed()
+        sys.exit(1)
+
+    # Ctrl+C is for less to handle, it shouldn't kill us while less is still running.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Quitting less before it read everything is perfectly normal.
+    try:
+        write_table(ps.stdin)
+    except BrokenPipeError:
+        pass
+
+    try:
+        ps.stdin.close()
+    except BrokenPipeError:
+        pass
 
+    ps.wait()
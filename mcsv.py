@@ -3,11 +3,13 @@
 import argparse
 import os
 import time
+import random
 import socket
 import select
 import webbrowser
 import traceback
 import abc
+import collections
 import typing
 
 from selenium import webdriver
@@ -28,6 +30,10 @@ class BrowserController(abc.ABC):
     def set_profile(self, profile: str) -> None:
         pass
 
+    @abc.abstractmethod
+    def set_headless(self) -> None:
+        pass
+
     @abc.abstractmethod
     def launch(self) -> WebDriver:
         pass
@@ -55,6 +61,9 @@ class ChromeController(BrowserController):
     def set_profile(self, profile: str) -> None:
         ChromeController.set_chromium_profile(self.options, profile)
 
+    def set_headless(self) -> None:
+        self.options.add_argument('--headless=new')
+
     def launch(self) -> WebDriver:
         return webdriver.Chrome(options=self.options)
         
@@ -66,6 +75,9 @@ class EdgeController(BrowserController):
     def set_profile(self, profile: str) -> None:
         ChromeController.set_chromium_profile(self.options, profile)
 
+    def set_headless(self) -> None:
+        self.options.add_argument('--headless=new')
+
     def launch(self) -> WebDriver:
         return webdriver.Edge(options=self.options)
 
@@ -77,6 +89,9 @@ class FirefoxController(BrowserController):
         # Takes a super long time to load fat profiles, and there's no way around it. Users are advised to create a lean profile just for this.
         self.options.profile = profile
 
+    def set_headless(self) -> None:
+        self.options.add_argument('-headless')
+
     def launch(self) -> WebDriver:
         return webdriver.Firefox(options=self.options)
 
@@ -104,15 +119,9 @@ def get_default_browser() -> str:
     # Default to edge. Sorry linux users.
     return EDGE
 
-def do_with_retries(action: typing.Callable[[], typing.Any], num_retries: int = 10, sleep_between_retries: float = 1.0) -> typing.Any:
-    for i in range(num_retries):
-        try:
-            return action()
-        except:
-            if i == num_retries - 1:
-                raise
-
-            time.sleep(sleep_between_retries)
+def retry_delay(attempt: int, sleep_between_retries: float = 0.5, max_sleep: float = 8.0) -> float:
+    # Most things work on the second try so we start quick, but if the page is really slow we don't want to hammer it.
+    return min(max_sleep, sleep_between_retries * 2 ** attempt) * random.uniform(0.5, 1.0)
 
 def is_alive(driver: WebDriver) -> bool:
     try:
@@ -130,35 +139,176 @@ def click_export_button(driver: WebDriver, export_button: WebElement) -> None:
         close_popup_button.click()
         raise
 
-def get_download_button(driver: WebDriver) -> WebElement:
-    # Try obtain the "in progress" text from the page. If it's there, that means the list isn't ready yet so we raise an exception.
+def xpath_literal(text: str) -> str:
+    # XPath has no escapes, so a string with both kinds of quotes has to be glued together with concat().
+    if "'" not in text:
+        return f"'{text}'"
+    if '"' not in text:
+        return f'"{text}"'
+
+    return 'concat(' + ", \"'\", ".join(f"'{part}'" for part in text.split("'")) + ')'
+
+def get_download_button(driver: WebDriver, list_name: str) -> WebElement:
     try:
-        driver.find_element(By.XPATH, "//span[text()='In progress']")
-        raise Exception('Still in progress')
-    # If there's no more "in progress" element in the page, we return the topmost download button.
-    except NoSuchElementException:
-        return driver.find_element(By.XPATH, "//button[contains(@aria-label, 'Start download for')]")
-    # If still in progress or failed to find it due to an unexpected exception type, refresh the page and propagate the exception so we'll retry.
+        # Several lists may be exporting at once, so we look at the topmost export of our list, which is the one we started.
+        # Only exports count, and the name has to be exactly our list's, or else a list like 'dvds wishlist' would pass for 'dvds'.
+        # If we couldn't get the list's name we have no choice but to go with the topmost export of any list.
+        is_export = ".//button[contains(@aria-label, 'Start download for')] or .//span[text()='In progress']"
+
+        if list_name != '':
+            name = xpath_literal(' '.join(list_name.split()))
+            export = driver.find_element(By.XPATH, f"//li[({is_export}) and .//*[normalize-space(text()) = {name}]]")
+        else:
+            export = driver.find_element(By.XPATH, f"//li[{is_export}]")
+
+        # Try obtain the "in progress" text from the export. If it's there, that means the list isn't ready yet so we raise an exception.
+        if len(export.find_elements(By.XPATH, ".//span[text()='In progress']")) > 0:
+            raise Exception('Still in progress')
+
+        return export.find_element(By.XPATH, ".//button[contains(@aria-label, 'Start download for')]")
+    # If still in progress or failed to find it, refresh the page and propagate the exception so we'll retry.
     except:
         driver.refresh()
         raise
 
-def export_list(driver: WebDriver, list_id: str) -> None:
-    driver.get(f'https://www.imdb.com/list/ls{list_id}')
+# Raised by a step that isn't ready yet but also hasn't failed, so it shouldn't use up a retry.
+class NotYet(Exception):
+    pass
+
+# Lists a directory's CSVs with their sizes.
+def list_csvs(downloads: str) -> dict[str, int]:
+    with os.scandir(downloads) as entries:
+        return {entry.name: entry.stat().st_size for entry in entries if entry.name.lower().endswith('.csv') and entry.is_file()}
+
+# An export of one list, running in its own tab. It's a sequence of steps, each of which is tried without blocking,
+# so that many exports can make progress at the same time. A step that raises is retried later, until it runs out of retries.
+class Export:
+    num_retries = 10
+    download_timeout = 60
+
+    # The export whose file we're waiting for in the downloads folder. Only one at a time, so we know whose file it is when one shows up.
+    downloading: typing.Optional['Export'] = None
+
+    def __init__(self, driver: WebDriver, tab: str, list_id: str, downloads: str, client: typing.Optional[socket.socket]) -> None:
+        self.driver = driver
+        self.tab = tab
+        self.list_id = list_id
+        self.downloads = downloads
+        self.client = client
+        self.list_name = ''
+        self.steps = [self.open_list, self.click_export, self.open_exports_page, self.click_download]
+        self.step = 0
+        self.attempt = 0
+        self.next_try = time.monotonic()
+
+        if downloads != '':
+            self.steps.append(self.wait_for_file)
+
+    def open_list(self) -> None:
+        self.driver.get(f'https://www.imdb.com/list/ls{self.list_id}')
+
+    def click_export(self) -> None:
+        # We need the list's name to find its export later. Not having it isn't a reason to fail though.
+        if self.list_name == '':
+            try:
+                self.list_name = self.driver.find_element(By.XPATH, '//h1').text.strip()
+            except:
+                pass
+
+        # Begin exporting.
+        click_export_button(self.driver, self.driver.find_element(By.XPATH, "//button[@aria-label='Export']"))
+
+    def open_exports_page(self) -> None:
+        # Go to exports page once the popup tells us.
+        self.driver.find_element(By.XPATH, "//a[@aria-label='Open exports page']").click()
+
+    def click_download(self) -> None:
+        if self.downloads != '' and Export.downloading not in (None, self):
+            raise NotYet()
+
+        # Hit the download button once the list is ready.
+        download_button = get_download_button(self.driver, self.list_name)
+
+        # Whatever's in the downloads folder from before isn't ours.
+        if self.downloads != '':
+            self.old_csvs = list_csvs(self.downloads)
+            self.last_sizes = dict()
+            self.download_deadline = time.monotonic() + Export.download_timeout
+            Export.downloading = self
+
+        download_button.click()
+
+    def wait_for_file(self) -> None:
+        # Browsers write downloads to a temporary file and rename it when they're done, except Firefox also makes an empty file with the final name right away.
+        # So it's ours when it's a new CSV that isn't empty, has no .part file next to it and didn't change size since we last looked.
+        csvs = list_csvs(self.downloads)
+        new_csvs = {name: size for name, size in csvs.items() if name not in self.old_csvs and size > 0}
+
+        for name, size in new_csvs.items():
+            if self.last_sizes.get(name) == size and not os.path.exists(os.path.join(self.downloads, f'{name}.part')):
+                self.path = os.path.join(self.downloads, name)
+                return
+
+        self.last_sizes = new_csvs
+
+        if time.monotonic() > self.download_deadline:
+            self.attempt = Export.num_retries - 1 # Not worth retrying, there's no way to tell if it will show up.
+            raise Exception('Timed out waiting for the download')
+
+        raise NotYet()
+
+    def done(self) -> bool:
+        return self.step == len(self.steps)
+
+    # Tells whoever asked for this list how it went.
+    def finish(self, ok: bool) -> None:
+        if Export.downloading is self:
+            Export.downloading = None
+
+        if self.client == None:
+            return
+
+        reply = f'{self.list_id} OK'
+
+        if not ok:
+            reply = f'{self.list_id} FAIL'
+        elif self.downloads != '':
+            reply += f' {self.path}'
 
-    # Begin exporting.
-    export_button = do_with_retries(
-        lambda: driver.find_element(By.XPATH, "//button[@aria-label='Export']"))
-    do_with_retries(lambda: click_export_button(driver, export_button))
+        try:
+            self.client.sendall(f'{reply}\n'.encode())
+        except OSError:
+            pass # They hung up, no one to tell.
 
-    # Go to exports page once the popup tells us.
-    exports_page_link = do_with_retries(
-        lambda: driver.find_element(By.XPATH, "//a[@aria-label='Open exports page']"))
-    do_with_retries(exports_page_link.click)
+    # Makes one attempt at the current step. Returns False if the export failed for good.
+    def advance(self) -> bool:
+        self.driver.switch_to.window(self.tab)
 
-    # Hit the download button once the list is ready.
-    download_button = do_with_retries(lambda: get_download_button(driver))
-    do_with_retries(download_button.click)
+        try:
+            self.steps[self.step]()
+        except NotYet:
+            self.next_try = time.monotonic() + 0.25
+            return True
+        except:
+            self.attempt += 1
+
+            if self.attempt == Export.num_retries:
+                print(f'Failed to export list {self.list_id}:')
+                traceback.print_exc()
+                self.finish(False)
+                return False
+
+            self.next_try = time.monotonic() + retry_delay(self.attempt - 1)
+            return True
+
+        self.step += 1
+        self.attempt = 0
+        self.next_try = time.monotonic()
+
+        if self.done():
+            self.finish(True)
+
+        return True
 
 def main() -> None:
     # Open the socket ASAP to minimize chances of someone sending a message into the void.
@@ -168,14 +318,31 @@ def main() -> None:
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind((host, port))
 
+    # Clients who want to know when their lists are downloaded connect over TCP on the same port instead, and get a line back for every list they ask for.
+    # It has to be TCP because bash reads sockets one byte at a time, which cuts UDP messages short.
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen()
+
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawTextHelpFormatter,
         description='''Acts as a server that you can request to download IMDb lists from.
-    Write IMDb list IDs to stdin separated by newlines, and it will download each list once it's written.
-    It's the client's responsibility to monitor the downloads folder for the downloaded files.''')
+    Send it IMDb list IDs over UDP or TCP on port 42069 separated by newlines, and it will download each list once it's sent. Send 'quit' to stop it.
+    With -d, TCP clients get back a line '<list-id> OK <path>' for every list once its file is downloaded, or '<list-id> FAIL'.
+    TCP clients can also send 'ping', which is answered with 'pong' once the browser is up and the server is ready.
+    Otherwise, it's the client's responsibility to monitor the downloads folder for the downloaded files.''')
     parser.add_argument('-b', '--browser', choices=(AUTO, CHROME, EDGE, FIREFOX), default=AUTO, action='store', help='Choose which browser to use.')
     parser.add_argument('-p', '--profile', metavar='PROFILE', default='', action='store', help=
         "Path to the browser profile to use. Good for using a profile where you're signed in to IMDb so you can download private lists.")
+    parser.add_argument('-c', '--concurrency', metavar='NUM', type=int, default=4, action='store', help=
+        'Export up to %(metavar)s lists at the same time, each in its own tab. Defaults to %(default)s.')
+    parser.add_argument('-d', '--downloads', metavar='DIR', default='', action='store', help=
+        "The browser's downloads folder. If given, each list is only done once its file is fully downloaded, and TCP clients are told where it is.")
+    parser.add_argument('-H', '--headless', default=False, action='store_true', help=
+        'Run the browser without a window. Handy when the server is kept running in the background.')
+    parser.add_argument('-i', '--idle-timeout', metavar='SECS', type=float, default=None, action='store', help=
+        'Quit by itself after being idle for %(metavar)s seconds. Idle means no lists to export and no TCP clients connected. By default it only quits when told to.')
     args = parser.parse_args()
 
     browser_name = get_default_browser() if args.browser == AUTO else args.browser
@@ -194,25 +361,93 @@ def main() -> None:
     if args.profile != '':
         controller.set_profile(args.profile)
 
+    if args.headless:
+        controller.set_headless()
+
+    concurrency = max(1, args.concurrency)
+    queue = collections.deque()
+    exports = dict() # Tab to the export running in it, or None if the tab is free.
+    quitting = False
+    clients = dict() # TCP clients and whatever they sent that doesn't end with a newline yet.
+
     # RATIONALE: we spin a server instead of running this script once per list ID because launching the browser takes time and we don't want to pay that cost multiple times.
     # NOTE: I wanted to minimize the browser window but it causes things to fail.
     with controller.launch() as driver:
+        # Tabs are opened as they're needed and then reused. We never close them, closing the last one would end the session.
+        exports[driver.current_window_handle] = None
+        idle_since = time.monotonic()
+
         while True:
             # We use select so we can have a timeout and check if the browser is still alive.
-            readable, _, _ = select.select((sock,), (), (), 1)
-
-            # "for s in readable" would have the same effect except if we get 'quit' break will only break out of the inner loop.
-            if len(readable) > 0:
-                data, _ = sock.recvfrom(1024)
-                list_id = data.decode().strip()
-
-                if list_id == 'quit':
+            # When exports are running, we wake up as soon as one of them is due for another try.
+            now = time.monotonic()
+            timeout = min([1.0] + [max(0.0, e.next_try - now) for e in exports.values() if e != None])
+            readable, _, _ = select.select([sock, listener, *clients], (), (), timeout)
+
+            for s in readable:
+                if s is sock:
+                    data, _ = sock.recvfrom(1024)
+                    requests = [(data.decode().strip(), None)]
+                elif s is listener:
+                    client, _ = listener.accept()
+                    clients[client] = b''
+                    requests = []
+                else:
+                    # TCP is a stream, so requests are only complete once we have their newline.
+                    data = s.recv(4096)
+
+                    if len(data) == 0:
+                        s.close()
+                        del clients[s]
+                        continue
+
+                    *lines, clients[s] = (clients[s] + data).split(b'\n')
+                    requests = [(line.decode().strip(), s) for line in lines if len(line.strip()) > 0]
+
+                for list_id, client in requests:
+                    if list_id == 'quit':
+                        quitting = True
+                    elif list_id == 'ping':
+                        # We only get here once the browser is up, so this also tells the client we're ready.
+                        if client != None:
+                            try:
+                                client.sendall(b'pong\n')
+                            except OSError:
+                                pass
+                    else:
+                        queue.append((list_id, client))
+
+            # Exports which were already requested still get to finish.
+            idle = len(queue) == 0 and all(e == None for e in exports.values())
+
+            if quitting and idle:
+                break
+
+            # When kept running in the background, we don't want to hold on to the browser forever.
+            if not idle or len(clients) > 0:
+                idle_since = time.monotonic()
+            elif args.idle_timeout != None and time.monotonic() - idle_since > args.idle_timeout:
+                break
+
+            # Start queued exports in free tabs, opening new tabs as long as we're below the concurrency.
+            while len(queue) > 0:
+                tab = next((t for t, e in exports.items() if e == None), None)
+
+                if tab == None and len(exports) < concurrency:
+                    driver.switch_to.new_window('tab')
+                    tab = driver.current_window_handle
+
+                if tab == None:
                     break
 
-                try:
-                    export_list(driver, list_id)
-                except:
-                    traceback.print_exc()
+                list_id, client = queue.popleft()
+                exports[tab] = Export(driver, tab, list_id, args.downloads, client)
+
+            # Give every export that's due a chance to make progress. Tabs of exports that are done or failed are freed.
+            for tab, export in exports.items():
+                if export != None and export.next_try <= time.monotonic():
+                    if not export.advance() or export.done():
+                        exports[tab] = None
 
             assert is_alive(driver)
 
@@ -20,13 +20,22 @@
 # TODO: Add index of the movie in the list, or alternatively add mbrowse column for index in the sort order, or even index in a different sort order?
 
 import json
+import pickle
+import gzip
+import copy
+import tempfile
 import csv
+import zlib
 import sys
 import os
 import argparse
 import re
 import datetime
-from collections import namedtuple
+import time
+import random
+import threading
+import concurrent.futures
+from collections import namedtuple, deque
 
 try:
     from imdb import Cinemagoer, IMDbError
@@ -59,6 +68,9 @@ try:
 except:
     pass
 
+# Every crew type we know how to download.
+people_keys = ['cast', 'director', 'writer', 'producer', 'composer', 'cinematographer', 'editor', 'stunt performer']
+
 parser = argparse.ArgumentParser(
     formatter_class=argparse.RawTextHelpFormatter,
     description='Give this an export of an IMDb list and it will output a JSON with additional data about the movies in the list.')
@@ -73,44 +85,94 @@ It's enough for %(metavar)s to match any part of the title, not necessarily the
 This feature is intended for redownloading shows after a new season has come out''')
 parser.add_argument('-m', '--max', metavar='NUM', type=int, default=0x7FFFFFFF, action='store', help=
     'Fetch no more than %(metavar)s movies. Mainly for debugging. Defaults to unbounded')
+parser.add_argument('-j', '--jobs', metavar='NUM', type=int, default=1, action='store', help=
+    'Download up to %(metavar)s movies at the same time. Output is the same regardless of this. Defaults to %(default)s')
+parser.add_argument('--rate', metavar='NUM', type=float, default=0, action='store', help=
+    'Start no more than %(metavar)s downloads per second, across all jobs. Use this if IMDb starts throttling you. Defaults to 0, which means unlimited')
+parser.add_argument('--crew', metavar='TYPES', default=','.join(people_keys), action='store', help=
+    f'''Comma-separated crew types to download and store in the JSON, or 'none'. Defaults to all of them: {", ".join(people_keys)}.
+If you only ever use a few crew types, this makes the JSON a lot smaller. With -u/--update,
+movies in the update JSON which are missing one of %(metavar)s are redownloaded, so you can add a crew type later on''')
+parser.add_argument('--info', metavar='SETS', default=None, action='store', help=
+    '''Comma-separated Cinemagoer info sets to download on top of the default ones. Mainly for debugging.
+Defaults to 'critic reviews' for the metascore, plus 'full credits' if any crew types are downloaded''')
+parser.add_argument('--tries', metavar='NUM', type=int, default=5, action='store', help=
+    'Try to download a movie or person up to %(metavar)s times before giving up. Defaults to %(default)s')
+parser.add_argument('--backoff', metavar='SECONDS', type=float, default=1, action='store', help=
+    '''After a failed try, wait about %(metavar)s seconds before trying again, and twice as long after every try after that.
+The wait is randomized a little so jobs don't retry all at once. Defaults to %(default)s''')
+parser.add_argument('--max-backoff', metavar='SECONDS', type=float, default=60, action='store', help=
+    'Never wait more than %(metavar)s seconds between tries. This is also how long all jobs pause for when the breaker trips. Defaults to %(default)s')
+parser.add_argument('--breaker', metavar='NUM', type=int, default=10, action='store', help=
+    '''If %(metavar)s tries in a row fail, across all jobs, pause all downloads for --max-backoff seconds.
+Failures in a row usually mean IMDb is throttling us. Defaults to %(default)s, 0 disables it''')
+parser.add_argument('--timings', metavar='FILE', default=None, action='store', help=
+    'Write a CSV to %(metavar)s with how long every try took and how it ended. Good for tuning -j and --rate')
+parser.add_argument('-c', '--cache', metavar='DIR', default=None, action='store', help=
+    '''Keep a copy of every downloaded movie in %(metavar)s, and reuse it instead of downloading the movie again.
+Good for lists that share a lot of movies, or for rebuilding a JSON from scratch. Movies forced with -f/--force are always redownloaded''')
+parser.add_argument('--cache-ttl', metavar='DAYS', type=float, default=30, action='store', help=
+    'Movies in the cache which were downloaded more than %(metavar)s days ago are downloaded again. Defaults to %(default)s')
+parser.add_argument('--cache-size', metavar='MB', type=float, default=512, action='store', help=
+    'When the cache grows beyond %(metavar)s megabytes, the movies which were least recently used are removed from it. Defaults to %(default)s')
+parser.add_argument('--store', default=False, action='store_true', help=
+    '''Also write a compact copy of the JSON to '<JSON>.mstore', without the .json. mprint and mbrowse load it instead of the JSON when it's newer,
+which is a lot faster on big lists. Ignored when outputting to standard output''')
+parser.add_argument('--delta', metavar='FILE', default=None, action='store', help=
+    '''Write which movies were added to, removed from, or changed in each output JSON to %(metavar)s, so mprint can update what it made from the JSON
+instead of making it all again (see mprint --delta). What's already in %(metavar)s about other JSONs is kept. Ignored when outputting to standard output''')
 parser.add_argument('-q', '--quiet', default=False, action='store_true', help=
     'Be quiet. Don\'t output anything other than the JSON to standard output')
+parser.add_argument('--no-journal', dest='journal', default=True, action='store_false', help=
+    '''Don't keep a journal. Normally every movie is written to '<JSON>.journal' as soon as it is downloaded, so if mfetch is killed or crashes,
+the next run picks up where it left off instead of downloading everything again''')
+parser.add_argument('-M', '--multi', default=False, action='store_true', help=
+    '''Fetch several lists at once. Every positional argument is treated as a CSV, and each is output to a JSON with the same name but with type .json.
+Movies that are in more than one of the lists are only downloaded once. With -u, every list is updated against its own output JSON.
+Can't be used with --update or with standard input/output''')
 parser.add_argument('CSV', action='store', help=
     'A CSV export of an IMDb list. If -, use standard input')
-parser.add_argument('JSON', nargs='?', default=None, action='store', help=
+parser.add_argument('JSON', nargs='*', action='store', help=
     '''A JSON file to output to. Defaults to the same name as the input file but with type .json.
 If %(dest)s is -, use standard output. If you use standard output, you'll probably also want to use -q.
-If CSV is -, %(dest)s must be specified''')
+If CSV is -, %(dest)s must be specified.
+With -M, these are more CSVs instead''')
 args = parser.parse_args()
 
-csvfile = args.CSV
 fetch_amount = args.max
 quiet = args.quiet
 forcepat = args.force
+jobs = args.jobs
+rate = args.rate
+cachedir = args.cache
+multi = args.multi
+use_journal = args.journal
+use_store = args.store
+deltafile = args.delta
 
-if args.JSON == None:
-    if csvfile == '-':
-        parser.error('the JSON argument is required if CSV is -')
+if jobs < 1:
+    parser.error('NUM for -j/--jobs must be at least 1')
 
-    outfile = csvfile.removesuffix('.csv') + '.json'
-else:
-    outfile = args.JSON
+if args.tries < 1:
+    parser.error('NUM for --tries must be at least 1')
+
+crew_keys = [] if args.crew.strip().lower() == 'none' else [key.strip().lower() for key in args.crew.split(',') if key.strip() != '']
+bad_keys = [key for key in crew_keys if key not in people_keys]
 
-upfile = args.update if args.update != None else outfile if args.u else None
+if len(bad_keys) > 0:
+    parser.error(f'invalid crew type(s) for --crew: {", ".join(bad_keys)}. Valid crew types are: {", ".join(people_keys)}')
 
-# Update mode means that we are updating an input file, not fetching everything from scratch.
-# If the path doesn't exist, we will simply toggle off update mode.
-# This check also catches the case that -u is passed in combination with JSON == -, btw.
-update_mode = upfile != None and os.path.exists(upfile)
+# Keeping them in the usual order no matter how they were given, so the JSON always looks the same.
+crew_keys = [key for key in people_keys if key in crew_keys]
 
-if upfile != None and not update_mode:
-    print(f'File \'{upfile}\' doesn\'t exist. Ignoring -u/--update args.', file=sys.stderr)
+# The main page only has some of the crew, the rest is in the full credits. So we can only skip it if we don't want any crew at all.
+if args.info != None:
+    info = (*Movie.default_info, *(name.strip() for name in args.info.split(',') if name.strip() != ''))
+else:
+    info = (*Movie.default_info, 'critic reviews', *(('full credits',) if len(crew_keys) > 0 else ()))
 
-# Building a list of CsvFields (id, watch date, release date, my rating) for every movie.
-# Obviously we need the id from the csv in order to know what to download.
-# But we are also interested in the watch date which is only in the csv,
-# and the release date which is obtainable from Cinemagoer but easier through the csv (trust me).
-all_csv_data = list()
+def has_crew(json_movie):
+    return all(key in json_movie for key in crew_keys)
 
 # Some movies (Saint Clara at least) have the release date written with just the year, so we have to patch that.
 def fix_date_format(date):
@@ -122,71 +184,336 @@ def fix_date_format(date):
 
     raise ValueError(f'Invalid date: {date}')
 
-with sys.stdin if csvfile == '-' else open(csvfile, 'r', newline='') as f:
-    reader = csv.reader(f)
+# Everything we need to know about a single list we're fetching. The movies themselves are downloaded for all lists together.
+class MovieList:
+    def __init__(self, csvfile, outfile, upfile):
+        self.csvfile = csvfile
+        self.outfile = outfile
 
-    for i, row in enumerate(reader):
-        if i == 0:
-            has_myrating = len(row) > 16
-            continue
+        # Every movie is written to the journal as soon as it's downloaded, and the journal is deleted once the output is written.
+        # So if we find a journal, the last run didn't finish and we can pick up where it left off.
+        self.journal_path = None if outfile == '-' or not use_journal else outfile + '.journal'
+        self.journal = None
 
-        all_csv_data.append(CsvFields(row[1][2:], row[5], fix_date_format(row[2]), fix_date_format(row[14]), row[16] if has_myrating else '', row[4], row[10], row[9], row[13]))
+        # Update mode means that we are updating an input file, not fetching everything from scratch.
+        # If the path doesn't exist, we will simply toggle off update mode.
+        # This check also catches the case that -u is passed in combination with JSON == -, btw.
+        self.upfile = upfile
+        self.update_mode = upfile != None and os.path.exists(upfile)
 
-all_csv_data = all_csv_data[:min(fetch_amount, len(all_csv_data))]
+        if upfile != None and not self.update_mode:
+            print(f'File \'{upfile}\' doesn\'t exist. Ignoring -u/--update args.', file=sys.stderr)
 
-# In update mode, we will filter out movies which are already in the input file.
-if update_mode:
-    with open(upfile, 'r') as f:
-        in_json = json.load(f)
-    
-    # Creating list of movie IDs which we want to redownload even if they are already in the input JSON.
-    if forcepat == None:
-        force_ids = []
-    else:
-        forcepat_compiled = re.compile(forcepat, flags=re.IGNORECASE)
-        force_ids = [movie['imdbID'] for movie in in_json['movies'] if forcepat_compiled.search(movie['title'])]
+    def read(self):
+        # Building a list of CsvFields (id, watch date, release date, my rating) for every movie.
+        # Obviously we need the id from the csv in order to know what to download.
+        # But we are also interested in the watch date which is only in the csv,
+        # and the release date which is obtainable from Cinemagoer but easier through the csv (trust me).
+        all_csv_data = list()
+
+        with sys.stdin if self.csvfile == '-' else open(self.csvfile, 'r', newline='') as f:
+            reader = csv.reader(f)
+
+            for i, row in enumerate(reader):
+                if i == 0:
+                    has_myrating = len(row) > 16
+                    continue
+
+                all_csv_data.append(CsvFields(row[1][2:], row[5], fix_date_format(row[2]), fix_date_format(row[14]), row[16] if has_myrating else '', row[4], row[10], row[9], row[13]))
+
+        self.all_csv_data = all_csv_data[:min(fetch_amount, len(all_csv_data))]
+
+        # In update mode, we will filter out movies which are already in the input file.
+        if self.update_mode:
+            with open(self.upfile, 'r') as f:
+                self.in_json = json.load(f)
+
+            # Creating list of movie IDs which we want to redownload even if they are already in the input JSON.
+            if forcepat == None:
+                self.force_ids = set()
+            else:
+                forcepat_compiled = re.compile(forcepat, flags=re.IGNORECASE)
+                self.force_ids = {movie['imdbID'] for movie in self.in_json['movies'] if forcepat_compiled.search(movie['title'])}
+
+            # Movies which were downloaded before we wanted some crew type have to be downloaded again to get it.
+            missing_crew_ids = {movie['imdbID'] for movie in self.in_json['movies'] if not has_crew(movie)}
+
+            if not quiet and len(missing_crew_ids) > 0:
+                print(f'Redownloading {len(missing_crew_ids)} movies which are missing crew types from \'{self.upfile}\'.')
+
+            self.force_ids |= missing_crew_ids
+
+            # Creating list of IDs which we don't need to download because of update mode.
+            no_redownload_ids = {movie['imdbID'] for movie in self.in_json['movies'] if movie['imdbID'] not in self.force_ids}
+
+            # Creating list of what we want to download by excluding the ones we don't.
+            self.csv_data = [fields for fields in self.all_csv_data if fields.iden not in no_redownload_ids]
+        else:
+            self.force_ids = set()
+            self.csv_data = self.all_csv_data
+
+        self.journaled = self.read_journal()
+        self.fetch_data = [fields for fields in self.csv_data if fields.iden not in self.journaled]
+        self.fetch_ids = {fields.iden for fields in self.fetch_data}
+
+    def read_journal(self):
+        journaled = dict()
+
+        if self.journal_path == None or not os.path.exists(self.journal_path):
+            return journaled
+
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                # If we were killed in the middle of writing a line, that line is broken and the movie will simply be downloaded again.
+                try:
+                    json_movie = json.loads(line)
+
+                    if has_crew(json_movie):
+                        journaled[json_movie['imdbID']] = json_movie
+                except (ValueError, KeyError, TypeError):
+                    pass
+
+        if not quiet and len(journaled) > 0:
+            print(f'Resuming {len(journaled)} movies from \'{self.journal_path}\'.')
+
+        return journaled
+
+    def write_journal(self, json_movie):
+        if self.journal_path == None:
+            return
+
+        if self.journal == None:
+            self.journal = open(self.journal_path, 'a', encoding='utf-8', newline='\n')
+
+        self.journal.write(json.dumps(json_movie) + '\n')
+        self.journal.flush()
+
+    def close_journal(self, delete):
+        if self.journal != None:
+            self.journal.close()
+
+        if self.journal_path == None:
+            return
 
-    # Creating list of IDs which we don't need to download because of update mode.
-    no_redownload_ids = [movie['imdbID'] for movie in in_json['movies'] if movie['imdbID'] not in force_ids]
+        if delete:
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+        else:
+            # A list we didn't finish always leaves a journal, even if none of its movies got downloaded, so that mup knows to fetch it again.
+            open(self.journal_path, 'a').close()
 
-    # Creating list of what we want to download by excluding the ones we don't.
-    csv_data = [fields for fields in all_csv_data if fields.iden not in no_redownload_ids]
+if multi:
+    if args.update != None:
+        parser.error('--update can\'t be used with -M/--multi')
+
+    csvfiles = [args.CSV, *args.JSON]
+
+    if '-' in csvfiles:
+        parser.error('standard input can\'t be used with -M/--multi')
+
+    outfiles = [csvfile.removesuffix('.csv') + '.json' for csvfile in csvfiles]
+    movie_lists = [MovieList(csvfile, outfile, outfile if args.u else None) for csvfile, outfile in zip(csvfiles, outfiles)]
 else:
-    csv_data = all_csv_data
+    csvfile = args.CSV
+
+    if len(args.JSON) > 1:
+        parser.error('only one JSON argument is allowed without -M/--multi')
+
+    if len(args.JSON) == 0:
+        if csvfile == '-':
+            parser.error('the JSON argument is required if CSV is -')
+
+        outfile = csvfile.removesuffix('.csv') + '.json'
+    else:
+        outfile = args.JSON[0]
+
+    upfile = args.update if args.update != None else outfile if args.u else None
+    movie_lists = [MovieList(csvfile, outfile, upfile)]
+
+for movie_list in movie_lists:
+    movie_list.read()
+
+# Building what we need to download for all lists together. Movies which are in several lists only appear once.
+unique_csv_data = dict()
+
+for movie_list in movie_lists:
+    for fields in movie_list.fetch_data:
+        unique_csv_data.setdefault(fields.iden, fields)
+
+csv_data = list(unique_csv_data.values())
+force_ids = {iden for movie_list in movie_lists for iden in movie_list.force_ids}
 
 # Fetching data about the movies.
 # Pairs of (key, default value).
 direct_keys = [('imdbID', 'N/A'), ('title', 'N/A'), ('metascore', '-1')]
 
-# Just the keys.
-people_keys = ['cast', 'director', 'writer', 'producer', 'composer', 'cinematographer', 'editor', 'stunt performer']
-ia = Cinemagoer()
+# Everything we download comes from the same host, so a single limiter for all threads is what keeps us polite.
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if self.interval == 0.0:
+            return
+
+        # Reserve the next free slot under the lock, but sleep outside of it so other threads can reserve theirs.
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+
+        time.sleep(start - now)
+
+# Decides how long to wait between tries when IMDb gives us errors, which usually means it's throttling us.
+# Every try waits twice as long as the previous one, times a random factor so the jobs don't all come back at the same moment.
+# When a lot of tries fail in a row the breaker trips, and then all the jobs hold off together instead of each one burning through its tries.
+class RetryPolicy:
+    def __init__(self, limiter, tries, backoff, max_backoff, breaker, timings):
+        self.limiter = limiter
+        self.tries = tries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker
+        self.failures = 0
+        self.closed_time = 0.0
+        self.lock = threading.Lock()
+        # Set when we're stopped (e.g., by Ctrl-C). Waits are done on it so they end right away, and nobody tries again after it.
+        self.stopped = threading.Event()
+        self.timings = None if timings == None else open(timings, 'w', newline='')
+        self.timings_writer = None if timings == None else csv.writer(self.timings)
+
+        if self.timings_writer != None:
+            self.timings_writer.writerow(['kind', 'id', 'try', 'start', 'seconds', 'result'])
+
+    def delay(self, attempt):
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def wait_breaker(self):
+        with self.lock:
+            remaining = self.closed_time - time.monotonic()
+
+        if remaining > 0:
+            self.stopped.wait(remaining)
+
+    def record(self, kind, iden, attempt, start, result):
+        seconds = time.monotonic() - start
+
+        with self.lock:
+            if result == 'ok':
+                self.failures = 0
+            else:
+                self.failures += 1
+
+                if self.breaker > 0 and self.failures >= self.breaker:
+                    self.closed_time = time.monotonic() + self.max_backoff
+                    self.failures = 0
+
+            if self.timings_writer != None:
+                self.timings_writer.writerow([kind, iden, attempt + 1, f'{time.time() - seconds:.3f}', f'{seconds:.3f}', result])
+                self.timings.flush()
+
+    # Returns None if every try failed.
+    def run(self, kind, iden, action):
+        for attempt in range(self.tries):
+            if attempt > 0:
+                self.stopped.wait(self.delay(attempt - 1))
+
+            self.wait_breaker()
+
+            if self.stopped.is_set():
+                return None
+
+            self.limiter.wait()
+            start = time.monotonic()
 
-# Building a list of Cinemagoer movie objects for the downloaded movies.
-movies = list()
-info = (*Movie.default_info, 'critic reviews', 'full credits')
-exit_early = None
+            try:
+                result = action()
+            except IMDbError as e:
+                self.record(kind, iden, attempt, start, type(e).__name__)
+                continue
 
-for i, fields in enumerate(csv_data):
-    progbar("Downloading", i, len(csv_data), suffix=fields.title)
-    success = False
+            self.record(kind, iden, attempt, start, 'ok')
+            return result
 
-    # Errors are rather common and usually trying again works.
-    for j in range(5):
+        return None
+
+    def stop(self):
+        self.stopped.set()
+
+    def close(self):
+        if self.timings != None:
+            self.timings.close()
+
+# Stores each movie as it was converted to JSON (before adding the CSV data) in its own gzipped file, named after its ID.
+# A file's modification time is when it was last used, which is what we evict by. When it was downloaded is stored inside.
+class Cache:
+    def __init__(self, path, ttl_days, max_mb):
+        self.path = path
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.max_size = max_mb * 1024 * 1024
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, iden):
+        return os.path.join(self.path, f'{iden}.json.gz')
+
+    def get(self, iden):
+        path = self.file(iden)
+
+        # A missing or broken entry is the same as a miss, we'll just download the movie and overwrite it.
         try:
-            movie = ia.get_movie(fields.iden, info=info)
-            movies.append(movie)
-            success = True
-            break
-        except IMDbError:
-            pass
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                entry = json.load(f)
+
+            if time.time() - entry['fetched'] > self.ttl:
+                return None
+
+            os.utime(path)
+            return entry['movie']
+        except (OSError, EOFError, ValueError, KeyError, TypeError):
+            return None
+
+    def put(self, iden, json_movie):
+        # Write to a temporary file and then move it so that a crash never leaves a half-written entry behind.
+        fd, temp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+
+        # GzipFile doesn't close a file it was given, so the raw file needs its own with, or it may not be all written when we move it.
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+                json.dump({'fetched': time.time(), 'movie': json_movie}, f)
+        except:
+            os.remove(temp)
+            raise
+
+        os.replace(temp, self.file(iden))
+
+    def evict(self):
+        entries = []
 
-    if not success:
-        print('Terminating early due to a problem with fetching data. You can pick up from where execution left off with --update.', file=sys.stderr)
-        exit_early = i
-        break
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.endswith('.json.gz'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
 
-progbar("Downloading", len(csv_data) if exit_early == None else exit_early, len(csv_data))
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            os.remove(path)
+            total -= size
+
+# I'm not sure Cinemagoer objects are safe to share between threads, so every thread gets its own.
+thread_data = threading.local()
+
+def cinemagoer():
+    if not hasattr(thread_data, 'ia'):
+        thread_data.ia = Cinemagoer()
+
+    return thread_data.ia
 
 # Converting data to JSON.
 def get(obj, key, default):
@@ -214,7 +541,7 @@ def json_person(person):
 
 def json_people(movie, key):
     people = get(movie, key, [])
-    filtered = list()
+    filtered = dict()
 
     for p in people:
         # Sometimes you get empty people.
@@ -222,45 +549,91 @@ def json_people(movie, key):
             continue
 
         # Sometimes you get the same person twice.
-        if sum(1 for person in filtered if person.getID() == p.getID()) > 0:
-            continue
-
-        filtered.append(p)
+        filtered.setdefault(p.getID(), p)
 
-    return [json_person(person) for person in filtered]
+    return [json_person(person) for person in filtered.values()]
 
-json_movies = list()
-result = {'movies': json_movies}
-
-for i, movie in enumerate(movies):
-    progbar("Building JSON", i, len(movies))
+def movie_to_json(movie):
     json_movie = dict()
     json_movie.update({key: get(movie, key, default) for key, default in direct_keys})
     # These keys will be added later, but I want them to appear before the crew keys in the file so we need to add them now too.
     json_movie.update({k: None for k in csv_to_json_keys})
     json_movie.update({'myrating': None, 'watched': None, 'released': None, 'description': None, 'runtime': None})
-    json_movie.update({key: json_people(movie, key) for key in people_keys})
-    json_movies.append(json_movie)
+    json_movie.update({key: json_people(movie, key) for key in crew_keys})
+    return json_movie
+
+limiter = RateLimiter(rate)
+retry = RetryPolicy(limiter, args.tries, args.backoff, args.max_backoff, args.breaker, args.timings)
+cache = None if cachedir == None else Cache(cachedir, args.cache_ttl, args.cache_size)
+
+# Taking what we can from the cache. Forced movies are skipped because the point of forcing them is that the data we have is outdated.
+cached_movies = dict()
+
+if cache != None:
+    for i, fields in enumerate(csv_data):
+        progbar("Reading cache", i, len(csv_data))
+
+        if fields.iden not in force_ids:
+            json_movie = cache.get(fields.iden)
+
+            if json_movie != None and has_crew(json_movie):
+                cached_movies[fields.iden] = json_movie
+
+    progbar("Reading cache", len(csv_data), len(csv_data))
 
-progbar("Building JSON", len(movies), len(movies))
+download_data = [fields for fields in csv_data if fields.iden not in cached_movies]
 
-# In update mode, appending movies from the input JSON except the ones which have been removed from the list or that were force redownloaded.
-if update_mode:
-    append_ids = [fields.iden for fields in all_csv_data if fields.iden not in force_ids]
-    json_movies += [movie for movie in in_json['movies'] if movie['imdbID'] in append_ids]
+# Building a dict of the downloaded movies, already converted to JSON.
+built_movies = dict()
+exit_early = None
+
+def download_movie(fields):
+    movie = retry.run('movie', fields.iden, lambda: cinemagoer().get_movie(fields.iden, info=info))
+
+    # Converting here, so the huge Cinemagoer object can be thrown away as soon as we're done with it.
+    return None if movie == None else movie_to_json(movie)
+
+# Downloads run in the background, but we collect them in list order so the output doesn't depend on which finished first.
+# If a movie can't be downloaded we stop at it like we would without jobs, and throw away whatever was downloaded after it.
+# We only let the downloads get a little ahead of the one we're waiting for, otherwise a single slow movie would have everything after it piling up in memory.
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+window = 2 * jobs
+futures = deque()
 
-# For data that we pull from the CSV, we'll update even movies that are skipped by update mode.
-# This is because it doesn't cost us anything, and because one of the values is my rating,
-# which can change so a movie which was already previous fetched may need to be updated.
-for i, fields in enumerate(all_csv_data):
-    progbar("Adding CSV data", i, len(all_csv_data))
-    json_movie = next((m for m in json_movies if m['imdbID'] == fields.iden), None)
+try:
+    for i, fields in enumerate(download_data):
+        while len(futures) < window and i + len(futures) < len(download_data):
+            futures.append(executor.submit(download_movie, download_data[i + len(futures)]))
 
-    # The only time it can be None is if the download phase got cut short due to an error.
-    if json_movie != None:
-        json_movie.update({k: getattr(fields, k) for k in csv_to_json_keys})
+        progbar("Downloading", i, len(download_data), suffix=fields.title)
+        built = futures.popleft().result()
 
-progbar("Adding CSV data", len(all_csv_data), len(all_csv_data))
+        if built == None:
+            print('Terminating early due to a problem with fetching data. You can pick up from where execution left off with --update.', file=sys.stderr)
+            exit_early = i
+            break
+
+        # The movie is saved everywhere it needs to be before we move on, so no matter when we're stopped it won't be downloaded again.
+        built_movies[fields.iden] = built
+
+        if cache != None:
+            cache.put(fields.iden, built)
+
+        for movie_list in movie_lists:
+            if fields.iden in movie_list.fetch_ids:
+                movie_list.write_journal(built)
+except BaseException:
+    # Shutting down waits for the jobs that are running, so the ones waiting to try again have to give up or Ctrl-C would wait for all their tries.
+    retry.stop()
+    raise
+finally:
+    # Also happens on Ctrl-C, so we don't keep downloading movies nobody is waiting for.
+    executor.shutdown(cancel_futures=True)
+
+progbar("Downloading", len(download_data) if exit_early == None else exit_early, len(download_data))
+
+if cache != None:
+    cache.evict()
 
 # There seems to be a bug in Cinemagoer, sometimes when you get a person from the cast list of a TV show,
 # his name goes something like "2011 Alan Tudyk\n          \n          \n          \n          1 episode".
@@ -271,41 +644,237 @@ def bad_name(person):
     name = person['name']
     return '\n' in name or ' episode' in name.lower()
 
-bad_people = [p for m in json_movies for k in people_keys for p in m[k] if bad_name(p)]
-exit_early = None
+# The store is the same data as the JSON but in a form that's much faster for mprint and mbrowse to load.
+# Each movie's fields are stored as a tuple, and the names of the fields are stored once for all movies that have the same ones.
+# Every person is stored once, and credits point at them. Every crew type is pickled separately, so readers only unpack the ones they use.
+def write_store(path, movies):
+    shapes = dict()
+    people = dict()
+    rows = list()
+    crews = {key: list() for key in people_keys}
+
+    for movie in movies:
+        keys = tuple(k for k in movie if k not in people_keys)
+        rows.append((shapes.setdefault(keys, len(shapes)), *(movie[k] for k in keys)))
+
+        for key in people_keys:
+            credits = movie.get(key)
+            crews[key].append(None if credits == None else tuple((people.setdefault((p['id'], p['name']), len(people)), tuple(p['roles'])) for p in credits))
+
+    store = {
+        'version': 1,
+        'shapes': list(shapes),
+        'people': list(people),
+        'rows': rows,
+        'crew': {key: pickle.dumps(credits, protocol=pickle.HIGHEST_PROTOCOL) for key, credits in crews.items()},
+    }
+
+    # Readers may be loading it right now, so they should see either the old store or the new one and nothing in between.
+    write_replacing(path, 'wb', lambda f: pickle.dump(store, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+# Writes a file by writing a temporary file next to it and moving it over the file. Readers see either the old file or the new one,
+# and if we're killed halfway the old one is still there.
+def write_replacing(path, mode, write, **kwargs):
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
 
-for i, person in enumerate(bad_people):
-    progbar("Cleansing data", i, len(bad_people))
-    iden = person['id']
-    good_appearances = [p for m in json_movies for k in people_keys for p in m[k] if iden == p['id'] and not bad_name(p)]
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            write(f)
+    except:
+        os.remove(temp)
+        raise
+
+    # mkstemp makes the file readable only by us, but it should get the same permissions a file we opened normally would.
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(temp, 0o666 & ~umask)
+    os.replace(temp, path)
+
+# A JSON's checksum is what its deltas are based on. mprint checks it to know that a delta goes from the JSON it saw last time to the one it sees now.
+def file_sum(data):
+    return f'{zlib.crc32(data)} {len(data)}'
+
+# Reads a JSON we're about to overwrite, or the one we just wrote, as its checksum and its movies by ID.
+# A movie can be in a list more than once, and then it changed if any one of its copies did.
+# Returns None if it can't be read, and then there's no delta for it. mprint just makes that list's files again from scratch.
+def read_for_delta(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None, dict()
+    except OSError as e:
+        print(f'Can\'t read \'{path}\' ({e}). Not writing a delta for it.', file=sys.stderr)
+        return None
+
+    movies = dict()
+
+    try:
+        for movie in json.loads(data)['movies']:
+            movies.setdefault(movie['imdbID'], []).append(movie)
+    except (ValueError, TypeError, KeyError) as e:
+        print(f'\'{path}\' isn\'t a JSON from mfetch ({e}). Not writing a delta for it.', file=sys.stderr)
+        return None
+
+    return file_sum(data), movies
+
+def write_delta(path, old, new):
+    base_sum, old_movies = old
+    new_sum, new_movies = new
+
+    try:
+        with open(deltafile, 'r') as f:
+            deltas = json.load(f)
+    except (FileNotFoundError, ValueError):
+        deltas = dict()
+
+    deltas[os.path.realpath(path)] = {
+        'base': base_sum,
+        'new': new_sum,
+        'added': [iden for iden in new_movies if iden not in old_movies],
+        'removed': [iden for iden in old_movies if iden not in new_movies],
+        'changed': [iden for iden, movie in new_movies.items() if iden in old_movies and old_movies[iden] != movie],
+    }
+
+    # Same as the store, mprint may be reading it right now.
+    write_replacing(deltafile, 'w', lambda f: json.dump(deltas, f))
+
+# Names we had to download, so that if a person is wrong in several lists we only download them once.
+downloaded_names = dict()
+
+def download_name(iden):
+    person = retry.run('person', iden, lambda: cinemagoer().get_person(iden))
+    return None if person == None else get(person, 'name', iden)
+
+def finish_list(movie_list):
+    # Putting cached and downloaded movies back together in list order. Movies we didn't get to because of an error are left out.
+    # If the same movie goes to several lists, each gets its own copy because the CSV data we add to it is different for every list.
+    json_movies = [built_movies.get(fields.iden, cached_movies.get(fields.iden, movie_list.journaled.get(fields.iden))) for fields in movie_list.csv_data]
+    got_all = None not in json_movies
+    json_movies = [json_movie if len(movie_lists) == 1 else copy.deepcopy(json_movie) for json_movie in json_movies if json_movie != None]
+    result = {'movies': json_movies}
+
+    # In update mode, appending movies from the input JSON except the ones which have been removed from the list or that were force redownloaded.
+    if movie_list.update_mode:
+        append_ids = {fields.iden for fields in movie_list.all_csv_data if fields.iden not in movie_list.force_ids}
+        json_movies += [movie for movie in movie_list.in_json['movies'] if movie['imdbID'] in append_ids]
+
+    # Movies from the update JSON, the cache or the journal may have crew types we didn't ask for, which would otherwise stay in the JSON forever.
+    # Dropping them so that every movie has the crew types we asked for and nothing else.
+    unwanted_keys = [key for key in people_keys if key not in crew_keys]
+
+    for json_movie in json_movies:
+        for key in unwanted_keys:
+            json_movie.pop(key, None)
+
+    # For data that we pull from the CSV, we'll update even movies that are skipped by update mode.
+    # This is because it doesn't cost us anything, and because one of the values is my rating,
+    # which can change so a movie which was already previous fetched may need to be updated.
+    all_csv_data = movie_list.all_csv_data
+    movies_by_id = dict()
+
+    # If a movie is in there twice, the CSV data goes to its first copy, and a later row of the same movie overwrites an earlier one's.
+    # With a single list, both rows of a movie we just got are actually the same dict, so every copy ends up with the data.
+    # With -M every row gets its own copy, so only the first one does.
+    for json_movie in json_movies:
+        movies_by_id.setdefault(json_movie['imdbID'], json_movie)
+
+    for i, fields in enumerate(all_csv_data):
+        progbar("Adding CSV data", i, len(all_csv_data))
+        json_movie = movies_by_id.get(fields.iden)
+
+        # The only time it can be None is if the download phase got cut short due to an error.
+        if json_movie != None:
+            json_movie.update({k: getattr(fields, k) for k in csv_to_json_keys})
+
+    progbar("Adding CSV data", len(all_csv_data), len(all_csv_data))
+
+    # One pass to learn everyone's real name from the places where Cinemagoer got it right.
+    bad_people = []
+    good_names = dict()
+
+    for m in json_movies:
+        for k in people_keys:
+            for p in m.get(k, []):
+                if bad_name(p):
+                    bad_people.append(p)
+                else:
+                    good_names.setdefault(p['id'], p['name'])
+
+    # The people we can't figure out by ourselves are downloaded, at the same time like the movies are.
+    unknown_ids = dict.fromkeys(p['id'] for p in bad_people if p['id'] not in good_names and p['id'] not in downloaded_names)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    exit_early = None
+
+    try:
+        futures = {iden: executor.submit(download_name, iden) for iden in unknown_ids}
+
+        for i, person in enumerate(bad_people):
+            progbar("Cleansing data", i, len(bad_people))
+            iden = person['id']
+            name = good_names.get(iden, downloaded_names.get(iden))
+
+            if name == None:
+                name = futures[iden].result()
+
+                if name == None:
+                    print('Terminating early due to a problem with fetching data. You can pick up from where execution left off with --update.', file=sys.stderr)
+                    exit_early = i
+                    break
+
+                downloaded_names[iden] = name
+
+            person['name'] = name
+    except BaseException:
+        retry.stop()
+        raise
+    finally:
+        executor.shutdown(cancel_futures=True)
 
-    if len(good_appearances) != 0:
-        person['name'] = good_appearances[0]['name']
+    progbar("Cleansing data", len(bad_people) if exit_early == None else exit_early, len(bad_people))
+
+    # The JSON is about to be overwritten, so this is the last chance to see what was in it.
+    write_deltas = deltafile != None and movie_list.outfile != '-'
+
+    if write_deltas:
+        old = read_for_delta(movie_list.outfile)
+
+    # Outputting. If we get killed while writing the JSON, the old one is still there for the next run to update.
+    if movie_list.outfile == '-':
+        json.dump(result, sys.stdout, indent=2)
     else:
-        success = False
+        write_replacing(movie_list.outfile, 'w', lambda f: json.dump(result, f, indent=2), newline='\n')
 
-        for j in range(5):
-            try:
-                good_person = ia.get_person(iden)
-                person['name'] = get(good_person, 'name', iden)
-                success = True
-                break
-            except IMDbError:
-                pass
-            
-        if not success:
-            print('Terminating early due to a problem with fetching data. You can pick up from where execution left off with --update.', file=sys.stderr)
-            exit_early = i
-            break
+    # Writing the store only once the JSON is in place. Then the store is newer and readers know it's up to date.
+    if use_store and movie_list.outfile != '-':
+        write_store(movie_list.outfile.removesuffix('.json') + '.mstore', json_movies)
 
-progbar("Cleansing data", len(bad_people) if exit_early == None else exit_early, len(bad_people))
+    # Comparing with what we wrote rather than with json_movies, because that's exactly what mprint will see.
+    if write_deltas and old != None:
+        new = read_for_delta(movie_list.outfile)
 
-# Outputting.
-with sys.stdout if outfile == '-' else open(outfile, 'w', newline='\n') as f:
-    json.dump(result, f, indent=2)
+        if new != None:
+            write_delta(movie_list.outfile, old, new)
 
-    # If writing to stdout, it will be closed when we exit this scope.
-    # So it's better to print done inside this scope.
-    if not quiet:
+    if not quiet and movie_list is movie_lists[-1]:
         print('Done!')
-    
+
+    # If we had to stop early the journal is still useful to the next run, so it stays.
+    # With -M a list that none of the missing movies are in is still complete.
+    complete = got_all and exit_early == None
+    movie_list.close_journal(delete=complete)
+    return complete
+
+completed = True
+
+for movie_list in movie_lists:
+    if multi and not quiet:
+        print(f'Finishing \'{movie_list.outfile}\':')
+
+    completed = finish_list(movie_list) and completed
+
+retry.close()
+
+# Whatever we did get is written out, but whoever runs us should know that the JSON is missing movies and needs another run.
+if not completed:
+    sys.exit(1)
@@ -16,10 +16,14 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import json
+import pickle
 import sys
 import datetime
 import argparse
 import os
+import zlib
+import collections
+import math
 
 class Person:
     def __init__(self, iden, name):
@@ -69,6 +73,37 @@ class Appearance:
         self.movie = movie
         self.roles = roles
 
+# Everything we sort groups by or print about them. Some of these are averages over all of the group's movies,
+# so we go over the movies once per group instead of every time a sort or a breakdown asks.
+# We keep sums and counts rather than running averages, so the averages don't depend on the order of the movies.
+class GroupStats:
+    def __init__(self, people, appearances):
+        ratings = [appearance.movie.rating for appearance in appearances if appearance.movie.rating != -1]
+        metascores = [appearance.movie.metascore for appearance in appearances if appearance.movie.metascore != -1]
+        myratings = [appearance.movie.myrating for appearance in appearances if appearance.movie.myrating != -1]
+
+        self.nmovies = len(appearances)
+        self.npeople = len(people)
+        self.rating_sum, self.rating_count = math.fsum(ratings), len(ratings)
+        self.votes_sum = sum(appearance.movie.votes for appearance in appearances)
+        self.metascore_sum, self.metascore_count = sum(metascores), len(metascores)
+        self.myrating_sum, self.myrating_count = sum(myratings), len(myratings)
+
+        # The people list itself is guaranteed to be already sorted.
+        self.alpha = tuple(p.name.lower() for p in people)
+
+        # An average of nothing is 0.
+        self.rating = self.rating_sum / self.rating_count if self.rating_count > 0 else 0.0
+        self.votes = self.votes_sum / self.nmovies if self.nmovies > 0 else 0.0
+        self.metascore = self.metascore_sum / self.metascore_count if self.metascore_count > 0 else 0.0
+        self.myrating = self.myrating_sum / self.myrating_count if self.myrating_count > 0 else 0.0
+
+# Makes GroupStats out of the dict that --state saves them as.
+def stats_from_dict(d):
+    stats = GroupStats.__new__(GroupStats)
+    stats.__dict__ = d
+    return stats
+
 def json_to_movie(json_movie, crew_type):
     iden = json_movie['imdbID']
     title = json_movie['title']
@@ -80,23 +115,76 @@ def json_to_movie(json_movie, crew_type):
     released = datetime.datetime.strptime(json_movie['released'], '%Y-%m-%d')
     description = json_movie['description']
     runtime = int(json_movie['runtime']) if len(json_movie['runtime']) != 0 else -1
-    json_crew = json_movie[crew_type]
+    # JSONs fetched with --crew may not have every crew type. Then it's as if nobody worked in that position.
+    json_crew = json_movie.get(crew_type, [])
     crew = [CrewMember(Person(c['id'], c['name']), c['roles']) for c in json_crew]
     return Movie(iden, title, rating, votes, metascore, myrating, watched, released, description, runtime, crew)
 
+# mfetch --store writes a compact copy of the JSON next to it, which is a lot faster to load. Mostly because we only unpack the crew types we use.
+# It's only used if it's newer than the JSON, otherwise the JSON was changed after it and it's out of date.
+def load_store(path, crew_types):
+    with open(path, 'rb') as f:
+        store = pickle.load(f)
+
+    if store['version'] != 1:
+        raise ValueError(f'Unknown store version: {store["version"]}')
+
+    shapes = store['shapes']
+    people = store['people']
+    movies = [dict(zip(shapes[row[0]], row[1:])) for row in store['rows']]
+
+    for crew_type in crew_types:
+        if crew_type not in store['crew']:
+            continue
+
+        for movie, credits in zip(movies, pickle.loads(store['crew'][crew_type])):
+            if credits != None:
+                movie[crew_type] = [{'id': people[i][0], 'name': people[i][1], 'roles': list(roles)} for i, roles in credits]
+
+    return {'movies': movies}
+
+def load_movies(matching_file, crew_types):
+    if matching_file != '-':
+        store_file = matching_file.removesuffix('.json') + '.mstore'
+
+        try:
+            if os.path.getmtime(store_file) >= os.path.getmtime(matching_file):
+                return load_store(store_file, crew_types)
+        except Exception:
+            # No store or a broken one, either way there's always the JSON.
+            pass
+
+    with sys.stdin if matching_file == '-' else open(matching_file, 'r') as f:
+        return json.load(f)
+
+# Has to be the same checksum mfetch --delta uses.
+def file_sum(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    return f'{zlib.crc32(data)} {len(data)}'
+
 def find_index(items, pred):
     return next((i for i, item in enumerate(items) if pred(item)), len(items))
 
-# Credit for this function: https://stackoverflow.com/a/31062966/12553917.
-def mean(data):
-    n = 0
-    mean = 0.0
- 
-    for x in data:
-        n += 1
-        mean += (x - mean) / n
+# Yields the positions of the bits that are set in mask, from lowest to highest.
+# Every operation on a big int makes a new int, so for masks with lots of bits set searching the binary string is faster than clearing bits one by one.
+# We don't know how many bits are set in advance, so we start clearing them and switch if there turns out to be many.
+def bits(mask):
+    for _ in range(8):
+        if not mask:
+            return
+
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
 
-    return mean
+    digits = bin(mask)[:1:-1]
+    i = digits.find('1')
+
+    while i != -1:
+        yield i
+        i = digits.find('1', i + 1)
 
 def alias(valid_items, aliases, item):
     aliases.update({key: key for key in valid_items})
@@ -133,6 +221,13 @@ def crew_alias(crew_type):
     }
     return alias(valid_crew_types, aliases, crew_type)
 
+def crew_aliases(crew_types):
+    if crew_types.lower() == 'all':
+        return list(valid_crew_types)
+
+    # Removing duplicates but keeping the order.
+    return list(dict.fromkeys(aliases(crew_alias, crew_types)))
+
 def sort_alias(sort_key):
     aliases = {
         'rdate': sk_released,
@@ -235,42 +330,42 @@ def exclude_aliases(exclude_keys):
 
 def sort_func(sort_key):
     if sort_key == sk_released:
-        return lambda appearance: appearance.movie.released
+        return lambda movie: movie.released
     if sort_key == sk_watched:
-        return lambda appearance: appearance.movie.watched
+        return lambda movie: movie.watched
     if sort_key == sk_rating:
-        return lambda appearance: appearance.movie.rating
+        return lambda movie: movie.rating
     if sort_key == sk_votes:
-        return lambda appearance: appearance.movie.votes
+        return lambda movie: movie.votes
     if sort_key == sk_metascore:
-        return lambda appearance: appearance.movie.metascore
+        return lambda movie: movie.metascore
     if sort_key == sk_myrating:
-        return lambda appearance: appearance.movie.myrating
+        return lambda movie: movie.myrating
     if sort_key == sk_runtime:
-        return lambda appearance: appearance.movie.runtime
+        return lambda movie: movie.runtime
     if sort_key == sk_alpha:
-        return lambda appearance: appearance.movie.title.lower()
+        return lambda movie: movie.title.lower()
 
-    return lambda appearance: 0
+    return lambda movie: 0
 
+# Groups are (people, appearances, stats) tuples.
 def gsort_func(gsort_key):
     if gsort_key == gsk_nmovies:
-        return lambda tup: len(tup[1])
+        return lambda group: group[2].nmovies
     if gsort_key == gsk_rating:
-        return lambda tup: mean(appearance.movie.rating for appearance in tup[1] if appearance.movie.rating != -1)
+        return lambda group: group[2].rating
     if gsort_key == gsk_votes:
-        return lambda tup: mean(appearance.movie.votes for appearance in tup[1])
+        return lambda group: group[2].votes
     if gsort_key == gsk_metascore:
-        return lambda tup: mean(appearance.movie.metascore for appearance in tup[1] if appearance.movie.metascore != -1)
+        return lambda group: group[2].metascore
     if gsort_key == gsk_myrating:
-        return lambda tup: mean(appearance.movie.myrating for appearance in tup[1] if appearance.movie.myrating != -1)
+        return lambda group: group[2].myrating
     if gsort_key == gsk_npeople:
-        return lambda tup: len(tup[0])
+        return lambda group: group[2].npeople
     if gsort_key == gsk_alpha:
-        # The people list itself is guaranteed to be already sorted.
-        return lambda tup: tuple(p.name.lower() for p in tup[0])
+        return lambda group: group[2].alpha
 
-    return lambda tup: 0
+    return lambda group: 0
 
 def is_default(movie_json, xkey):
     if xkey == sk_metascore:
@@ -288,8 +383,9 @@ def get_squish(creds, *gsorters):
     max_ngroups = 0
 
     for gs_func in gsorters:
-        group_max_gval = max((gs_func(group) for group in creds), default=0)
-        group_max_ngroups = max((sum(1 for group in creds if gs_func(group) == gval) for gval in range(1, group_max_gval + 1)), default=1)
+        counts = collections.Counter(gs_func(group) for group in creds)
+        group_max_gval = max(counts, default=0)
+        group_max_ngroups = max((counts[gval] for gval in range(1, group_max_gval + 1)), default=1)
 
         if group_max_ngroups > max_ngroups:
             max_ngroups = group_max_ngroups
@@ -297,14 +393,17 @@ def get_squish(creds, *gsorters):
     return -(max_ngroups // -max_chars)
 
 def create_breakdown(creds, title, breakdown_gsorter, squish):
+    # Counting how many groups have every value in one go.
+    counts = collections.Counter(breakdown_gsorter(group) for group in creds)
+
     # Getting the largest value we have for this group key.
-    max_gval = max((breakdown_gsorter(group) for group in creds), default=1)
+    max_gval = max(counts, default=1)
 
     # Collecting all the data we want about each value. We want it as an int, as a str, how many groups have this value,
     # and a string of underscores that represents that same number.
     def add_data(gval):
         gval_str = str(gval)
-        ngroups = sum(1 for group in creds if breakdown_gsorter(group) == gval)
+        ngroups = counts[gval]
         underscores = "_" * -(ngroups // -squish) # We use a trick to turn division with floor into ceiling.
         return gval, gval_str, ngroups, underscores
 
@@ -400,8 +499,19 @@ parser.add_argument('-r', '--reverse-movies', default=True, action='store_false'
     'Reverse the sort order of movies')
 parser.add_argument('-R', '--reverse-groups', default=True, action='store_false', help=
     'Reverse the sort order of groups')
-parser.add_argument('CREW', type=crew_alias, action='store', help=
-    f'''The type of crewmember to organize movies by.
+parser.add_argument('-o', '--output', metavar='DIR', default=None, action='store', help=
+    '''Write each crew type to its own file '%(metavar)s/<crew type>.txt' instead of standard output, and print each crew type's name when it's done.
+Required if CREW has more than one crew type''')
+parser.add_argument('--state', default=False, action='store_true', help=
+    '''With -o/--output, also keep what went into each crew type's file in 'DIR/.<crew type>.mstate', so that a later run with --delta
+can update the file instead of making it all again''')
+parser.add_argument('--delta', metavar='FILE', default=None, action='store', help=
+    '''Update the files in -o/--output using %(metavar)s, which was written by mfetch.py --delta, and the state kept by --state (implies --state).
+Only the groups of people who were in movies that changed are made again. A file is made from scratch if it has no state, if it was made
+with different options or JSONs, or if the JSONs changed in ways %(metavar)s doesn't cover''')
+parser.add_argument('CREW', type=crew_aliases, action='store', help=
+    f'''The type of crewmember to organize movies by. Can be a comma-delimited list of crew types, or 'all' for all of them.
+The JSONs are read only once for all crew types, which is a lot faster than running this once per crew type.
 Valid crew types: {", ".join(valid_crew_types)}''')
 parser.add_argument('JSON', nargs='*', action='store', help=
     '''A list of input JSONs, which were output by mfetch.py. They will be treated as a single list of unique movies. Supports:
@@ -417,19 +527,44 @@ if args.print:
     print('\n'.join(valid_crew_types))
     exit()
 
-crew_type = args.CREW
+crew_types = args.CREW
 sort_keys = args.sort
 gsort_keys = args.group_sort
 reverse_movies = args.reverse_movies
 reverse_groups = args.reverse_groups
 min_length = args.min
 jsonfiles = ['-'] if len(args.JSON) == 0 else args.JSON
-group_mode = True if args.group == 'always' else False if args.group == 'never' else default_grouping[crew_type]
 exclude_keys = args.exclude
+outdir = args.output
+keep_state = args.state or args.delta != None
+
+if outdir == None and len(crew_types) > 1:
+    parser.error('-o/--output is required when there is more than one crew type')
 
-movies = set()
+if keep_state and outdir == None:
+    parser.error('--state and --delta require -o/--output')
+
+if keep_state and '-' in jsonfiles:
+    parser.error('--state and --delta can\'t be used with standard input')
+
+# A missing delta is the same as one where nothing changed.
+delta = dict()
+
+if args.delta != None:
+    try:
+        with open(args.delta, 'r') as f:
+            delta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        pass
+
+# Reading all the JSONs once, no matter how many crew types we're printing.
+json_movies = list()
 read_stdin = False
 
+# For --state, which JSONs we read and what was in them.
+inputs = list()
+sums = dict()
+
 for jsonfile in jsonfiles:
     # Ugly way to skip stdin after the first time because it will be closed for subsequent times.
     if jsonfile == '-':
@@ -448,131 +583,326 @@ for jsonfile in jsonfiles:
     except:
         sys.exit(f"{jsonfile}: No such file.")
         
-    with sys.stdin if matching_file == '-' else open(matching_file, 'r') as f:
-        data = json.load(f)
-
-    not_excluded = [m for m in data['movies'] if all(not is_default(m, xkey) for xkey in exclude_keys)]
-    movies.update(json_to_movie(m, crew_type) for m in not_excluded)
-
-if group_mode:
-    # High level, the algorithm is as follows:
-    #
-    # foreach movie:
-    #     intersect movie's people set with every other movie's
-    #     if the intersection with a movie (including self) is not empty, add that intersection to a set of sets
-    #
-    # foreach people set in the set of sets we built:
-    #     find all movies whose person set is a superset of this set
-    #
-    # In the end you have for every relevant person set, all movies that are accredited to it.
-    # In reality the algorithm barely resembles this because of various optimizations.
-
-    # people_sets will in the end include all relevant people sets. We know that at minimum, it should have every set that any movie has.
-    # This set also allows us to only iterate over every unique movie crew pair, instead of every movie pair.
-    people_sets = {movie.people for movie in movies if len(movie.people) > 0}
-
-    # Optimization: we only need to only iterate over each *unordered* crew pair once. For that we need people_sets to be ordered.
-    unique_people = list(people_sets)
-
-    # Optimization: 1-man crews are not interesting. Any intersection they have is either empty or equal to themselves.
-    # So we will sort by crew length, and get the first index where crews have a greater length than 1.
-    unique_people.sort(key=lambda people: len(people))
-    start_multiple = find_index(unique_people, lambda people: len(people) > 1)
-
-    # Now we iterate over every unordered pair of crews that both have len > 1.
-    for i, p1 in enumerate(unique_people[start_multiple:]):
-
-        # We skip the pair of any crew with itself because we started off people_sets with all of those.
-        for p2 in unique_people[i + 1:]:
-            intersection = p1 & p2
-
-            # Empty intersections are skipped.
-            # If the intersection is equal to p1 or p2, it's already in people_sets so we will not re-add it.
-            # If we did re-add it the set will block it anyway but it doing it this way is more optimal.
-            # For extra optimization juice, we don't even compare the sets, comparing lengths is enough.
-            if len(intersection) not in [0, len(p1), len(p2)]:
-                people_sets.add(intersection)
-
-    # This is step 2 of the algorithm: finding each people set's credits.
-    creds = [(people, [Appearance(movie, []) for movie in movies if people.issubset(movie.people)]) for people in people_sets]
-else: # Not group mode.
-    creds = dict()
-
-    for movie in movies:
-        for crewmember in movie.crew:
-            person = frozenset([crewmember.person])
-            appearance = Appearance(movie, crewmember.roles)
-
-            if person not in creds:
-                creds[person] = [appearance]
-            else:
-                creds[person].append(appearance)
-
-    creds = list(creds.items())
-        
-# Filtering credits below the min length.
-creds = [(sorted(people, key=lambda p: p.name), appearances) for people, appearances in creds if len(appearances) >= min_length]
+    data = load_movies(matching_file, crew_types)
+
+    if keep_state:
+        inputs.append(os.path.realpath(matching_file))
+        sums[inputs[-1]] = file_sum(matching_file)
+
+    json_movies.extend(m for m in data['movies'] if all(not is_default(m, xkey) for xkey in exclude_keys))
+
+# Finds every group of people who worked together, or every person on their own when not in group mode, and their credits.
+# If only is given, it's a set of person IDs and only the groups with one of them in are found.
+def find_groups(movies, group_mode, only=None):
+    # A group with one of them in only has movies with one of them in. So the rest of the movies can't make any difference.
+    if only != None:
+        movies = [movie for movie in movies if any(person.iden in only for person in movie.people)]
+
+    if group_mode:
+        # High level, the algorithm is as follows:
+        #
+        # foreach movie:
+        #     intersect movie's people set with every other movie's
+        #     if the intersection with a movie (including self) is not empty, add that intersection to a set of sets
+        #
+        # foreach people set in the set of sets we built:
+        #     find all movies whose person set is a superset of this set
+        #
+        # In the end you have for every relevant person set, all movies that are accredited to it.
+        # In reality the algorithm barely resembles this because of various optimizations.
+
+        # people_sets will in the end include all relevant people sets. We know that at minimum, it should have every set that any movie has.
+        # This set also allows us to only iterate over every unique movie crew pair, instead of every movie pair.
+        people_sets = {movie.people for movie in movies if len(movie.people) > 0}
+
+        # Optimization: we only need to only iterate over each *unordered* crew pair once. For that we need people_sets to be ordered.
+        unique_people = list(people_sets)
+
+        # Optimization: 1-man crews are not interesting. Any intersection they have is either empty or equal to themselves.
+        # So we will sort by crew length, and get the first index where crews have a greater length than 1.
+        unique_people.sort(key=lambda people: len(people))
+        start_multiple = find_index(unique_people, lambda people: len(people) > 1)
+
+        # Optimization: most pairs of crews have nobody in common, and intersecting them is a waste of time.
+        # So every crew is kept as a bitset of its people, and every person as a bitset of the crews they're in.
+        # ORing together the crews of everyone in a crew gives us exactly the crews it should be intersected with,
+        # and intersecting two crews is just an AND. Python ints are arbitrarily long so they make fine bitsets.
+        person_nums = dict()
+        person_crews = list()
+        crew_masks = list()
+        crew_nums = list()
+
+        for j, people in enumerate(unique_people[start_multiple:]):
+            nums = [person_nums.setdefault(person, len(person_nums)) for person in people]
+            mask = 0
+
+            for num in nums:
+                if num == len(person_crews):
+                    person_crews.append(0)
+
+                person_crews[num] |= 1 << j
+                mask |= 1 << num
+
+            # When we only want groups with someone from only in them, the only pairs we need are those that have one of them in common.
+            if only != None:
+                nums = [num for num, person in zip(nums, people) if person.iden in only]
+
+            crew_nums.append(nums)
+            crew_masks.append(mask)
+
+        # Now we iterate over every unordered pair of crews that both have len > 1 and have someone in common.
+        # We go over the pairs in the same order as we would if we tried all of them, because the order we add sets in decides the order they
+        # come out of people_sets, which decides the order of groups that tie when sorting.
+        seen = set()
+
+        for i, mask1 in enumerate(crew_masks):
+            candidates = 0
+
+            for num in crew_nums[i]:
+                candidates |= person_crews[num]
+
+            # We skip the pair of any crew with itself because we started off people_sets with all of those, and earlier crews were already paired with this one.
+            for j in bits(candidates >> (i + 1)):
+                j += i + 1
+                mask2 = crew_masks[j]
+                intersection = mask1 & mask2
+
+                # If the intersection is equal to p1 or p2, it's already in people_sets so we will not re-add it.
+                # Lots of pairs have the same intersection, and we only need to add it the first time.
+                if intersection != mask1 and intersection != mask2 and intersection not in seen:
+                    seen.add(intersection)
+                    people_sets.add(unique_people[start_multiple + i] & unique_people[start_multiple + j])
+
+        # This is step 2 of the algorithm: finding each people set's credits.
+        # Every person gets a bitset of the movies they're in, and ANDing those of everyone in a group leaves exactly the group's movies.
+        # Bits are numbered by each movie's position so the movies come out in the same order as they are in movies.
+        movies = list(movies)
+        person_movies = dict()
+
+        for k, movie in enumerate(movies):
+            for person in movie.people:
+                person_movies[person] = person_movies.get(person, 0) | (1 << k)
+
+        def group_movies(people):
+            mask = -1
+
+            for person in people:
+                mask &= person_movies[person]
+
+            return bits(mask)
+
+        return [(people, [Appearance(movies[k], []) for k in group_movies(people)]) for people in people_sets]
+    else: # Not group mode.
+        creds = dict()
+
+        for movie in movies:
+            for crewmember in movie.crew:
+                if only != None and crewmember.person.iden not in only:
+                    continue
+
+                person = frozenset([crewmember.person])
+                appearance = Appearance(movie, crewmember.roles)
+
+                if person not in creds:
+                    creds[person] = [appearance]
+                else:
+                    creds[person].append(appearance)
+
+        return list(creds.items())
+
+# A group's part of the file. The appearances have to be sorted already.
+def render_group(people, appearances, stats):
+    group_header = (
+f'''{", ".join(person.name for person in people)}:
+    Total: {stats.nmovies}
+    Average Rating: {stats.rating:.2f}
+    Average Metascore: {stats.metascore:.2f}
+    ~~~~~~~~~~~~~~~~~
+''')
+
+    # We'll align the column where we start writing roles. For this we'll need the longest movie name.
+    maxlen = max(len(appearance.movie.title) for appearance in appearances)
+    group_movies = '\n'.join(
+        f'    {appearance.movie.title}' if len(appearance.roles) == 0 else (
+        # We write '-'s between the movie name and the roles for alignment.
+        f'    {appearance.movie.title} {"-" * (1 + maxlen - len(appearance.movie.title))} {", ".join(appearance.roles)}')
+        for appearance in appearances
+    )
+
+    return f'{group_header}{group_movies}\n\n'
+
+# --state keeps the groups of every crew type's file, already printed, with everything needed to sort them and to print the header.
+# With a delta from mfetch that tells us which movies changed, only the groups of people who were in them can be any different,
+# so only those have to be made again and the rest are copied from the state.
+state_version = 1
+
+def state_path(crew_type):
+    return os.path.join(outdir, f'.{crew_type}.mstate')
 
-# Sorting by number of movies from each people set.
-for gsk in gsort_keys[::-1]:
-    creds.sort(key=gsort_func(gsk), reverse=reverse_groups)
+# Returns the state of CREW_TYPE and the IDs of the movies that changed since it was saved, or None if the file has to be made from scratch.
+def load_state(crew_type, fingerprint):
+    try:
+        with open(state_path(crew_type), 'rb') as f:
+            state = pickle.load(f)
+    except Exception:
+        return None
+
+    if state['version'] != state_version or state['fingerprint'] != fingerprint:
+        return None
+
+    state['groups'] = [(people, group, stats_from_dict(stats)) for people, group, stats in state['groups']]
+
+    changed = set()
+
+    # A JSON that's the same as last time has nothing to update. One that isn't needs a delta from exactly what we saw to exactly what's there now,
+    # or else something happened in between that the delta doesn't know about (like mfetch running twice).
+    for path, new_sum in sums.items():
+        old_sum = state['sums'][path]
+
+        if old_sum == new_sum:
+            continue
+
+        entry = delta.get(path)
+
+        if entry == None or entry['base'] != old_sum or entry['new'] != new_sum:
+            return None
+
+        changed.update(entry['added'], entry['removed'], entry['changed'])
+
+    return state, changed
+
+def save_state(crew_type, state):
+    # GroupStats are kept as dicts, so that the state doesn't depend on what module the class was in when it was pickled.
+    state['groups'] = [(people, group, vars(stats)) for people, group, stats in state['groups']]
+    temp = state_path(crew_type) + '.tmp'
+
+    with open(temp, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    os.replace(temp, state_path(crew_type))
+
+# Prints the file for CREW_TYPE and returns the state to keep for it.
+def print_crew(crew_type, file):
+    group_mode = True if args.group == 'always' else False if args.group == 'never' else default_grouping[crew_type]
+
+    # The IDs of every movie's people. Movies are unique by ID and the first one wins, same as when they're put in a set.
+    # This is all that updating needs to know about most movies, and it's a lot quicker to get than making them into Movies.
+    movie_people = dict()
+
+    for m in json_movies:
+        if m['imdbID'] not in movie_people:
+            movie_people[m['imdbID']] = tuple(c['id'] for c in m.get(crew_type, []))
+
+    # Everything that decides what goes in the file other than the movies themselves.
+    fingerprint = (crew_type, group_mode, sort_keys, gsort_keys, reverse_movies, reverse_groups, min_length, exclude_keys, inputs)
+    loaded = load_state(crew_type, fingerprint) if args.delta != None else None
+    movies = set()
+
+    if loaded == None:
+        groups = list()
+        movies.update(json_to_movie(m, crew_type) for m in json_movies)
+        creds = find_groups(movies, group_mode)
+    else:
+        state, changed = loaded
+
+        # The people who were in a changed movie before it changed and the people who are in it now.
+        affected = set()
+
+        for iden in changed:
+            affected.update(state['movie_people'].get(iden, ()))
+            affected.update(movie_people.get(iden, ()))
+
+        # Only movies with one of them in can be in the groups we make again, so those are the only ones we need as Movies.
+        seen = set()
+
+        for m in json_movies:
+            if m['imdbID'] not in seen:
+                seen.add(m['imdbID'])
+
+                if not affected.isdisjoint(movie_people[m['imdbID']]):
+                    movies.add(json_to_movie(m, crew_type))
+
+        groups = [group for group in state['groups'] if affected.isdisjoint(group[0])]
+        creds = find_groups(movies, group_mode, affected)
 
-# Computing these two in 1-liners with reduce proved to be the most expensive thing about this program by far
-total_people_shown = set()
-total_people = set()
+    # Filtering credits below the min length.
+    creds = [(sorted(people, key=lambda p: p.name), appearances) for people, appearances in creds if len(appearances) >= min_length]
+    creds = [(people, appearances, GroupStats(people, appearances)) for people, appearances in creds]
 
-for people, _ in creds:
-    total_people_shown.update(people)
+    # Every group's movies are sorted the same way, so rather than sorting every group by every key, the movies are sorted once and each group just sorts by that.
+    # It has to be the same order the appearances were made in, so that movies which tie on every key keep their order.
+    ranked = list(movies)
 
-for movie in movies:
-    total_people.update(movie.people)
+    for sk in sort_keys[::-1]:
+        ranked.sort(key=sort_func(sk), reverse=reverse_movies)
+
+    rank = {movie: i for i, movie in enumerate(ranked)}
+
+    # Groups from here on are (person IDs, printed group, stats), which is how the state keeps them.
+    for people, appearances, stats in creds:
+        appearances.sort(key=lambda appearance: rank[appearance.movie])
+        groups.append((frozenset(person.iden for person in people), render_group(people, appearances, stats), stats))
+
+    # Sorting by number of movies from each people set.
+    # Groups from the state are already sorted, so when updating, the sort mostly has to find where the new ones go.
+    for gsk in gsort_keys[::-1]:
+        groups.sort(key=gsort_func(gsk), reverse=reverse_groups)
+
+    # Computing these two in 1-liners with reduce proved to be the most expensive thing about this program by far
+    total_people_shown = set()
+    total_people = set()
+
+    for people, _, _ in groups:
+        total_people_shown.update(people)
+
+    for people in movie_people.values():
+        total_people.update(people)
 
-gsorter_nmovies = gsort_func(gsk_nmovies)
-gsorter_rating = gsort_func(gsk_rating)
-gsorter_metascore = gsort_func(gsk_metascore)
-gsorter_npeople = gsort_func(gsk_npeople)
+    gsorter_nmovies = gsort_func(gsk_nmovies)
+    gsorter_npeople = gsort_func(gsk_npeople)
 
-print(
-f'''Total groups shown: {len(creds)}
+    print(
+f'''Total groups shown: {len(groups)}
 Total people shown: {len(total_people_shown)}
 Total people: {len(total_people)}
-''')
+''', file=file)
 
-# We want a uniform squish for both breakdowns.
-if group_mode:
-    squish = get_squish(creds, gsorter_nmovies, gsorter_npeople)
-else:
-    squish = get_squish(creds, gsorter_nmovies)
+    # We want a uniform squish for both breakdowns.
+    if group_mode:
+        squish = get_squish(groups, gsorter_nmovies, gsorter_npeople)
+    else:
+        squish = get_squish(groups, gsorter_nmovies)
     
-print(create_breakdown(creds, '# of Groups For Every # of Movies', gsorter_nmovies, squish))
+    print(create_breakdown(groups, '# of Groups For Every # of Movies', gsorter_nmovies, squish), file=file)
 
-if group_mode:
-    print(create_breakdown(creds, '# of Groups For Every Group Size', gsorter_npeople, squish))
+    if group_mode:
+        print(create_breakdown(groups, '# of Groups For Every Group Size', gsorter_npeople, squish), file=file)
 
-print()
+    print(file=file)
 
-for people, appearances in creds:
-    group = (people, appearances)
+    # It's better to build the big strings in memory then write them all in one than to make a bunch of little calls to print.
+    file.write(''.join(group for _, group, _ in groups))
 
-    for sk in sort_keys[::-1]:
-        appearances.sort(key=sort_func(sk), reverse=reverse_movies)
+    return {
+        'version': state_version,
+        'fingerprint': fingerprint,
+        'sums': sums,
+        'movie_people': movie_people,
+        'groups': groups,
+    }
 
-    group_header = (
-f'''{", ".join(person.name for person in people)}:
-    Total: {gsorter_nmovies(group)}
-    Average Rating: {gsorter_rating(group):.2f}
-    Average Metascore: {gsorter_metascore(group):.2f}
-    ~~~~~~~~~~~~~~~~~
-''')
+if outdir == None:
+    print_crew(crew_types[0], sys.stdout)
+else:
+    os.makedirs(outdir, exist_ok=True)
 
-    # We'll align the column where we start writing roles. For this we'll need the longest movie name.
-    maxlen = max(len(appearance.movie.title) for appearance in appearances)
-    group_movies = '\n'.join(
-        f'    {appearance.movie.title}' if len(appearance.roles) == 0 else (
-        # We write '-'s between the movie name and the roles for alignment.
-        f'    {appearance.movie.title} {"-" * (1 + maxlen - len(appearance.movie.title))} {", ".join(appearance.roles)}')
-        for appearance in appearances
-    )
+    for crew_type in crew_types:
+        with open(os.path.join(outdir, f'{crew_type}.txt'), 'w', encoding='utf-8', newline='\n') as f:
+            state = print_crew(crew_type, f)
+
+        # Only once the file is all there, so the state never says it has something the file doesn't.
+        if keep_state:
+            save_state(crew_type, state)
 
-    # It's better to build the big strings in memory then print them all in one than to make a bunch of little calls to print.
-    print(group_header, group_movies, '\n', sep='')
+        # Lets whoever runs us show progress.
+        print(crew_type, flush=True)
@@ -42,10 +42,15 @@ profile="$MOVIES_PROFILE"
 browser=auto
 popts=()
 fopts=()
+gen_jobs=1
+keep_alive=0
+headless=false
+quit_mcsv=false
 handle_option() {
     case "$1" in
-        o) ## Disable optimizations that may cause the script to not function as expected.
-           ##> Use this if you notice your category wasn't re-generated despite being different from last time.
+        o) ## Disable optimizations that may cause the script to not function as expected. Every list and category is made again from scratch.
+           ##> Use this if you notice your category wasn't re-generated despite being different from last time,
+           ##> or if a movie's crew is out of date because mfetch took it from its cache.
             do_optimize=false
             ;;
         m) ## DIR ## The movies directory. This is where output is placed. Defaults to MOVIES_DIR env variable, or the current directory if it doesn't exist.
@@ -64,6 +69,14 @@ handle_option() {
             [[ "$2" == @(edge|chrome|firefox|auto) ]] || utils::die "Invalid BROWSER: '$2'"
             browser="$2"
             ;;
+        k) ## SECS ## Keep the browser used for exporting lists running in the background until it's been idle for SECS seconds,
+           ##> so that if you run mup again before then it doesn't have to launch the browser again. Defaults to 0, which closes it right away.
+            [[ "$2" =~ ^[0-9]+$ ]] || utils::die "Invalid SECS: '$2'"
+            keep_alive="$2"
+            ;;
+        H) ## Run the browser used for exporting lists headless, meaning without a window.
+            headless=true
+            ;;
         f) ## Skip the step where mfetch is run to update the local JSONs. Use the JSONs that already exist in the movies directory.
             do_fetch=false
             ;;
@@ -73,6 +86,11 @@ handle_option() {
         F) ## OPTS ## Semicolon-delimited options to pass to mfetch. DON'T pass '-u/--update' here. Don't forget to escape/quote the semicolons!
             readarray -td \; fopts < <(echo -n "$2")
             ;;
+        j) ## NUM ## Generate up to NUM categories at the same time. Categories made of bigger lists are started first,
+           ##> and if there are fewer categories than NUM, categories are also split up by crew type. Defaults to 1.
+            [[ "$2" =~ ^[1-9][0-9]*$ ]] || utils::die "Invalid NUM: '$2'"
+            gen_jobs="$2"
+            ;;
         P) ## OPTS ## Semicolon-delimited options to pass to mprint. DON'T pass '-p' here, and '-G' is not recommended.
            ##> It's your responsibility to ensure this doesn't conflict with the category mprint options.
             readarray -td \; popts < <(echo -n "$2")
@@ -137,70 +155,141 @@ fi
 (( $# == 0 )) && set -- "${!default_lists[@]}"
 (( $# == 0 )) && utils::die "No LIST provided and there are no defaults set up"
 
-# We'll use the browser to fetch the list export because some lists are private and in the browser you're already signed in.
-# But before, we have to know what's the current most recent csv in the downloads folder, so that we'll know when it changes.
-get_latest_csv() {
-    find "$downloads" -maxdepth 1 -iname '*.csv' -printf '%B@ %f\0' | sort -znr | head -zn 1 | cut -zd ' ' -f 2- | head -c -1
-}
+# Connects to the mcsv server which handles list download requests, and sets mcsv to the connection. Unlike with UDP, the server can answer us over TCP.
+# The server may already be running from an earlier run with -k. If it's not, we spin one.
+connect_mcsv() {
+    local reply
+
+    if ! { exec {mcsv}<>/dev/tcp/127.0.0.1/42069; } 2> /dev/null; then
+        local mcsv_opts=(-p "$profile" -b "$browser" -d "$downloads")
+        $headless && mcsv_opts+=(-H)
+
+        if (( keep_alive > 0 )); then
+            # It has to outlive us, so it's not one of our jobs and it quits by itself when it's been idle long enough.
+            nohup mcsv.py "${mcsv_opts[@]}" -i "$keep_alive" &> /dev/null &
+            disown
+        else
+            mcsv.py "${mcsv_opts[@]}" &
+            quit_mcsv=true
+        fi
 
-fetch() {
-    ! $do_fetch && return 0
+        # It opens its socket right away, so this doesn't take long.
+        SECONDS=0
+        until { exec {mcsv}<>/dev/tcp/127.0.0.1/42069; } 2> /dev/null; do
+            (( SECONDS > 10 )) && return 1
+            sleep 0.1
+        done
+    fi
 
-    local lid="$1"
-    local out_csv="$2.csv"
-    local out_json="$2.json"
+    # The server only answers once the browser is up, however long that takes.
+    echo ping >&$mcsv
+    IFS='' read -t 120 -r -u $mcsv reply && [[ "$reply" == pong ]]
+}
 
-    echo "Downloading '$out_csv'..."
+# We'll use the browser to fetch the list export because some lists are private and in the browser you're already signed in.
+# Downloads every list in the associative array named by the first argument, which maps list IDs to the names of the lists to save them as (space-separated).
+# The mcsv server exports them all at once, and tells us each list's file as soon as it's downloaded.
+# Sets downloaded to the names of the lists that were downloaded.
+download() {
+    local -n lists_by_id="$1"
+    local timeout=120
+    local lid lname lnames reply_lid status in_csv
+    downloaded=()
+    (( ${#lists_by_id[@]} == 0 )) && return
+
+    connect_mcsv || { echo "Failed to start the mcsv server. Skipping all lists" >&2; return 1; }
+
+    for lid in "${!lists_by_id[@]}"; do
+        for lname in ${lists_by_id[$lid]}; do echo "Downloading '$lname.csv'..."; done
+        echo "$lid" >&$mcsv
+    done
 
-    local initial_csv="$(get_latest_csv)"
-    local timeout=40
-    SECONDS=0
+    # Every list gets a reply, so we wait for as many replies as we sent requests. There's no waiting for files or anything, the server does that.
+    # The timeout is only in case the server gets stuck. It's per reply, since lists finish one after another.
+    local -A pending=()
+    for lid in "${!lists_by_id[@]}"; do pending["$lid"]=1; done
 
-    # If the server hasn't been spun yet or it died, spin a server which handles list download requests.
-    if ! jobs %% &> /dev/null; then
-        mcsv.py -p "$profile" -b "$browser" &
+    while (( ${#pending[@]} > 0 )) && IFS=' ' read -t $timeout -r -u $mcsv reply_lid status in_csv; do
+        [[ -v pending["$reply_lid"] ]] || continue
+        unset pending["$reply_lid"]
+        read -ra lnames <<< "${lists_by_id[$reply_lid]}"
 
-        # Give it time to start listening on the UDP socket, and also launch the browser.
-        sleep 3
-    fi
+        if [[ "$status" != OK || ! -f "$in_csv" ]]; then
+            for lname in "${lnames[@]}"; do echo "Failed to download '$lname.csv'. Skipping it" >&2; done
+            continue
+        fi
 
-    # Request to download this list from the server.
-    echo "$lid" > /dev/udp/127.0.0.1/42069
+        # The same list ID can have several names, they all get a copy.
+        for lname in "${lnames[@]:1}"; do cp -- "$in_csv" "$mdir/$lname.csv"; done
+        mv -- "$in_csv" "$mdir/${lnames[0]}.csv" && downloaded+=("${lnames[@]}")
+    done
 
-    # We'll try to obtain the most recent csv in the downloads folder, until it's a different one than before we started downloading.
-    while local in_csv="$(get_latest_csv)"; [[ "$initial_csv" == "$in_csv" ]]; do
-        if (( SECONDS > timeout )); then
-            echo "Timed out when trying to download '$out_csv'. Skipping it" >&2
-            return 1
-        fi
+    for lid in "${!pending[@]}"; do
+        for lname in ${lists_by_id[$lid]}; do echo "Timed out when trying to download '$lname.csv'. Skipping it" >&2; done
     done
 
-    # When the file is created it's sometimes empty for a bit. At some point it jumps to being fully written, without any inbetween.
-    # So this waits for the file size to not be zero.
-    # NOTE: [[ -e "..." ]] would be a lot nicer but for some reason it sometimes creates a copy of the file and messes everything up.
-    while (( "$(stat --format="%s" "$downloads/$in_csv")" == 0 )); do
-        if (( SECONDS > timeout )); then
-            echo "Timed out when trying to download '$out_csv'. Skipping it" >&2
-            return 1
+    exec {mcsv}>&-
+}
+
+# Prints one checksum of all the arguments together.
+checksum() {
+    printf "%s\0" "$@" | cksum
+}
+
+# The manifest remembers what each list's JSON and each category's files were made from, so we know what's already up to date.
+# Its lines are '<key> <checksum>', where keys are 'fetch:<list>', 'json:<list>', 'category:<category>' and 'options:<category>'.
+manifest_file="$mdir/.mmanifest"
+declare -A manifest=()
+[[ -f "$manifest_file" ]] && while IFS=' ' read -r key sum; do manifest["$key"]="$sum"; done < "$manifest_file"
+
+write_manifest() {
+    local key
+    for key in "${!manifest[@]}"; do printf "%s %s\n" "$key" "${manifest[$key]}"; done | sort > "$manifest_file.tmp" && mv -- "$manifest_file.tmp" "$manifest_file"
+}
+
+# Runs mfetch once for all the given lists, so that movies which are in several of them are only downloaded once.
+fetch() {
+    (( $# == 0 )) && return
+    ! $do_fetch && return
+
+    local lname
+    local csvs=()
+    local fetched=()
+    local -A fingerprints=()
+    local mfetch_sum="$(cksum < "$scripts"/mfetch.py)"
+
+    # A list's JSON only needs to be made again if its CSV changed, or the way we run mfetch did, or if the JSON was changed since we made it.
+    # Or if mfetch didn't finish it last time, in which case it left a journal behind to pick up from.
+    for lname in "$@"; do
+        fingerprints["$lname"]="$(checksum "$(cksum < "$mdir/$lname.csv")" "$mfetch_sum" "${fopts[@]}")"
+
+        if $do_optimize && [[ -f "$mdir/$lname.json" && ! -e "$mdir/$lname.json.journal" && "${manifest[fetch:$lname]}" == "${fingerprints[$lname]}" && "${manifest[json:$lname]}" == "$(cksum < "$mdir/$lname.json")" ]]; then
+            continue
         fi
-    done
 
-    mv "$downloads/$in_csv" "$mdir/$out_csv"
+        csvs+=("$mdir/$lname.csv")
+        fetched+=("$lname")
+    done
 
-    # The optimization is that we'll diff the JSON mfetch outputs with the existing one,
-    # and if nothing has changed then we won't run mprint for this later.
-    if $do_optimize && [[ -f "$mdir/$out_json" ]]; then
-        local temp_json="$(mktemp -p "$mdir")"
-        "$scripts"/mfetch.py --update "$mdir/$out_json" "${fopts[@]}" -- "$mdir/$out_csv" "$temp_json" || { rm -- "$temp_json"; return 1; }
+    (( ${#csvs[@]} == 0 )) && return
 
-        # diff exits with 0 when the files are identical.
-        diff -q -- "$mdir/$out_json" "$temp_json" > /dev/null && local ret=1 || local ret=0
-        mv -- "$temp_json" "$mdir/$out_json"
-        return $ret
+    # The optimization is that we'll only download movies which aren't already in the existing JSONs.
+    # Lists often share movies, so mfetch also keeps a cache of everything it downloads for all lists to use.
+    # mfetch also writes down which movies it changed in each JSON, so mprint can update the categories instead of making them again.
+    if $do_optimize; then
+        "$scripts"/mfetch.py -M -u --store --cache "$mdir/.mcache" --delta "$mdir/.mdelta" "${fopts[@]}" -- "${csvs[@]}" || return
     else
-        "$scripts"/mfetch.py "${fopts[@]}" -- "$mdir/$out_csv"
-        return 0
+        "$scripts"/mfetch.py -M --store "${fopts[@]}" -- "${csvs[@]}" || return
     fi
+
+    # mfetch fails if it didn't get every movie, but a list it didn't finish is also one that still has a journal.
+    for lname in "${fetched[@]}"; do
+        [[ -e "$mdir/$lname.json.journal" ]] && continue
+        manifest["fetch:$lname"]="${fingerprints[$lname]}"
+        manifest["json:$lname"]="$(cksum < "$mdir/$lname.json")"
+    done
+
+    write_manifest
 }
 
 # Similar trick to what we did with default_lists,
@@ -216,40 +305,118 @@ readarray -d '' -O ${#uniqlists[@]} uniqlists < <(printf "%s\0" "$@" | grep -Fxz
 # so in that case we'll create a pattern that matches nothing.
 (( ${#list_ids[@]} > 0 )) && lname_pat="@($(utils::join '|' "${!list_ids[@]}"))" || lname_pat='!(*)'
 
-# Fetch what we need.
+# Download what we need. First we figure out the ID of every list, then they're all downloaded together.
+declare -A requests=()
+
 for lname in "${uniqlists[@]}"; do
     case "$lname" in
         $lname_pat) # lname is one of the lists in the config file.
-            # We'll make a note to generate all categories that use this list if it was fetched successfully.
-            fetch "${list_ids[$lname]}" "$lname" && for cname in "${!cat_lists[@]}"; do
-                declare -n clists="${cat_lists[$cname]}"
-                utils::contains "$lname" "${clists[@]}" && gen_cats["$cname"]=1
-            done
+            lid="${list_ids[$lname]}"
             ;;
         +([[:word:]])) # lname is not in the config file, we will assume it's an IMDb list ID.
-            if fetch "$lname" "$lname"; then
-                # Creating a new list and category for this list ID.
-                list_ids["$lname"]="$lname"
-                cat_popts["$lname"]=mup_var$(( namei++ ))
-                cat_lists["$lname"]=mup_var$(( namei++ ))
-                declare -n cpopts="${cat_popts[$lname]}"
-                declare -n clists="${cat_lists[$lname]}"
-                cpopts=()
-                clists=("$lname")
-                gen_cats["$lname"]=1
-            fi
+            lid="$lname"
             ;;
         *)
             utils::die "Invalid LIST: '$lname'"
             ;;
     esac
+
+    # List names are word characters only, so they're safe to keep space-separated.
+    requests["$lid"]="${requests[$lid]:+${requests[$lid]} }$lname"
+done
+
+if $do_fetch; then
+    download requests
+else
+    downloaded=("${uniqlists[@]}")
+fi
+
+for lname in "${downloaded[@]}"; do
+    [[ "$lname" == $lname_pat ]] && continue
+
+    # Creating a new list and category for this list ID.
+    list_ids["$lname"]="$lname"
+    cat_popts["$lname"]=mup_var$(( namei++ ))
+    cat_lists["$lname"]=mup_var$(( namei++ ))
+    declare -n cpopts="${cat_popts[$lname]}"
+    declare -n clists="${cat_lists[$lname]}"
+    cpopts=()
+    clists=("$lname")
+done
+
+# Kill the server if we started it. If we don't do this now it will happen when this script quits anyway.
+# A server that was kept alive is left alone, it will quit when it's been idle long enough.
+$quit_mcsv && echo quit > /dev/udp/127.0.0.1/42069
+
+# We'll make a note to generate all categories that use a list if it was fetched successfully.
+fetch "${downloaded[@]}"
+
+for lname in "${downloaded[@]}"; do
+    for cname in "${!cat_lists[@]}"; do
+        declare -n clists="${cat_lists[$cname]}"
+        utils::contains "$lname" "${clists[@]}" && gen_cats["$cname"]=1
+    done
+done
+
+# Sets jsons to the JSONs that category CNAME is made of. Fails if one of them is missing.
+category_jsons() {
+    local cname="$1"
+    declare -n clists="${cat_lists[$cname]}"
+
+    # We need to surround the lnames with mdir before and .json after,
+    # and I don't think any of the quick ways to do it are robust to all the weird characters mdir could have.
+    jsons=()
+    for lname in "${clists[@]}"; do jsons+=("$mdir/$lname.json"); done
+
+    # We'll skip this category if one of its dependencies is missing.
+    for json in "${jsons[@]}"; do
+        [[ ! -f "$json" ]] && { echo "Category '$cname' requires file '$json' which doesn't exist. Skipping it" >&2; return 1; }
+    done
+
+    return 0
+}
+
+# A category's files only need to be made again if one of its JSONs changed, or the way we run mprint did.
+# That includes the options in the configuration file, so changing them is enough to have the category made again.
+# When only the JSONs changed, mprint can update the files with what mfetch says changed instead of making them from scratch.
+declare -A cat_options=()
+declare -A cat_fingerprints=()
+mprint_sum="$(cksum < "$scripts"/mprint.py)"
+
+for cname in "${!gen_cats[@]}"; do
+    declare -n cpopts="${cat_popts[$cname]}"
+    declare -n clists="${cat_lists[$cname]}"
+    category_jsons "$cname" 2> /dev/null || continue # It will be skipped and reported later.
+    sums=()
+    for json in "${jsons[@]}"; do sums+=("$(cksum < "$json")"); done
+    cat_options["$cname"]="$(checksum "$mprint_sum" ${#popts[@]} "${popts[@]}" ${#cpopts[@]} "${cpopts[@]}" "${clists[@]}")"
+    cat_fingerprints["$cname"]="$(checksum "${cat_options[$cname]}" "${sums[@]}")"
+
+    if $do_optimize && [[ -d "$mdir/$cname" && "${manifest[category:$cname]}" == "${cat_fingerprints[$cname]}" ]]; then
+        unset gen_cats["$cname"]
+    fi
 done
 
-# Kill the server if it's running. If we don't do this now it will happen when this script quits anyway.
-echo quit > /dev/udp/127.0.0.1/42069
+# Sets sopts to the options that make mprint keep its state for category CNAME, and use it if it's good.
+# mprint can tell by itself if the state doesn't match the options or the JSONs, but not if mprint itself changed since.
+state_opts() {
+    local cname="$1"
+    sopts=(--state)
+
+    if $do_optimize && [[ "${manifest[options:$cname]}" == "${cat_options[$cname]}" ]]; then
+        sopts+=(--delta "$mdir/.mdelta")
+    fi
+}
+
+# Remembering what a category was made from once it's all made.
+made_category() {
+    local cname="$1"
+    manifest["category:$cname"]="${cat_fingerprints[$cname]}"
+    manifest["options:$cname"]="${cat_options[$cname]}"
+}
 
 # Conditionally also running mprint to update the text files.
-if $do_gen; then
+if $do_gen && (( gen_jobs == 1 )); then
     readarray -t crew_types < <("$scripts"/mprint.py -p cast) # CREW doesn't matter.
     len=${#crew_types[@]}
 
@@ -257,27 +424,89 @@ if $do_gen; then
     (( max_cname = "$(printf "%s\n" "${!gen_cats[@]}" | tr -c '\n' x | sort -r | head -n 1 | wc -c)" + 4 ))
     
     for cname in "${!gen_cats[@]}"; do
-        declare -n clists="${cat_lists[$cname]}"
         declare -n cpopts="${cat_popts[$cname]}"
+        category_jsons "$cname" || continue
+        state_opts "$cname"
 
-        # We need to surround the lnames with mdir before and .json after,
-        # and I don't think any of the quick ways to do it are robust to all the weird characters mdir could have.
-        jsons=()
-        for lname in "${clists[@]}"; do jsons+=("$mdir/$lname.json"); done
-
-        # We'll skip this category if one of its dependencies is missing.
-        for json in "${jsons[@]}"; do
-            [[ ! -f "$json" ]] && { echo "Category '$cname' requires file '$json' which doesn't exist. Skipping it" >&2; continue 2; }
-        done
-
-        mkdir -p "$mdir/$cname"
+        # mprint reads the JSONs once and writes every crew type's file, printing each crew type when it's done so we can show progress.
         i=0
-        for crew in "${crew_types[@]}"; do
-            echo -ne "Generating category $(printf "%-${max_cname}s" "'$cname': ")[$(utils::repeat "#" $i)$(utils::repeat " " $(( len - i )))]\r"
-            "$scripts"/mprint.py "${popts[@]}" "${cpopts[@]}" -- "$crew" "${jsons[@]}" > "$mdir/$cname/$crew.txt"
+        echo -ne "Generating category $(printf "%-${max_cname}s" "'$cname': ")[$(utils::repeat " " $len)]\r"
+
+        while IFS='' read -r crew; do
             (( i++ ))
-        done
+            echo -ne "Generating category $(printf "%-${max_cname}s" "'$cname': ")[$(utils::repeat "#" $i)$(utils::repeat " " $(( len - i )))]\r"
+        done < <("$scripts"/mprint.py "${popts[@]}" "${cpopts[@]}" "${sopts[@]}" -o "$mdir/$cname" -- all "${jsons[@]}")
 
         echo -e "Generating category $(printf "%-${max_cname}s" "'$cname': ")[$(utils::repeat "#" $len)]"
+
+        # If mprint failed partway, it didn't get to print all the crew types.
+        (( i == len )) && made_category "$cname"
+    done
+elif $do_gen; then
+    readarray -t crew_types < <("$scripts"/mprint.py -p cast) # CREW doesn't matter.
+    len=${#crew_types[@]}
+    cats=()
+
+    for cname in "${!gen_cats[@]}"; do
+        category_jsons "$cname" && cats+=("$cname")
+    done
+
+    # If there are fewer categories than jobs, we split each category's crew types between a few mprints so all the jobs have something to do.
+    # Every mprint reads the JSONs again, so we don't split more than we have to.
+    (( chunks = ${#cats[@]} == 0 ? 1 : (gen_jobs + ${#cats[@]} - 1) / ${#cats[@]} ))
+    (( chunks > len )) && chunks=$len
+    units=()
+
+    # Bigger JSONs take longer, so we start with those and the short ones fill the gaps at the end.
+    # The category names are safe to split on spaces because we only allow word characters in them.
+    for cname in "${cats[@]}"; do
+        category_jsons "$cname"
+        size="$(cat -- "${jsons[@]}" | wc -c)"
+        for (( c = 0; c < chunks; c++ )); do units+=("$size $c $cname"); done
+    done
+
+    readarray -t units < <(printf "%s\n" "${units[@]}" | sort -k1,1nr -k3,3 -k2,2n | grep -v '^$')
+    declare -A running=()
+    declare -A failed_cats=()
+    ndone=0
+    total=${#units[@]}
+
+    # One bar for everything because jobs finish in whatever order they want, and this way what you see doesn't depend on it.
+    progress() {
+        echo -ne "Generating categories: [$(utils::repeat "#" $ndone)$(utils::repeat " " $(( total - ndone )))]\r"
+    }
+
+    # Waits for any one of our mprints to finish. We can't just use 'wait -n' because the mcsv server might be the one to finish.
+    wait_one() {
+        local finished
+        wait -n -p finished "${!running[@]}" || failed_cats["${running[$finished]}"]=1
+        unset running["$finished"]
+        (( ndone++ ))
+        progress
+    }
+
+    progress
+
+    for unit in "${units[@]}"; do
+        read -r size c cname <<< "$unit"
+        declare -n cpopts="${cat_popts[$cname]}"
+        category_jsons "$cname"
+        state_opts "$cname"
+
+        crews=()
+        for (( k = c; k < len; k += chunks )); do crews+=("${crew_types[k]}"); done
+
+        while (( ${#running[@]} >= gen_jobs )); do wait_one; done
+        "$scripts"/mprint.py "${popts[@]}" "${cpopts[@]}" "${sopts[@]}" -o "$mdir/$cname" -- "$(IFS=,; echo -n "${crews[*]}")" "${jsons[@]}" > /dev/null &
+        running[$!]="$cname"
+    done
+
+    while (( ${#running[@]} > 0 )); do wait_one; done
+    echo
+
+    for cname in "${cats[@]}"; do
+        [[ -v failed_cats["$cname"] ]] || made_category "$cname"
     done
 fi
+
+$do_gen && write_manifest